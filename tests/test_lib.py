@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 import unittest
+import os
 import sys
+import tempfile
+import time
+import json
+import re
+import io
+import mmap
+import threading
 sys.path.append('.')
 
 from yap import expand_env_soft
@@ -12,6 +20,27 @@ exec(call_lib)
 from yap import missing_lib
 exec(missing_lib)
 
+from yap import convert_lib
+exec(convert_lib)
+
+from yap import jobs_lib
+exec(jobs_lib)
+
+from yap import async_lib
+exec(async_lib)
+
+from yap import csv_lib
+exec(csv_lib)
+
+from yap import table_lib
+exec(table_lib)
+
+from yap import config_lib, hooks_lib, spill_lib, coproc_lib
+exec(config_lib)
+exec(hooks_lib)
+exec(spill_lib)
+exec(coproc_lib)
+
 
 def B(s):
     " Avoid quoting backslashes all the time "
@@ -37,6 +66,566 @@ class Test(unittest.TestCase):
                 B(escaped),
             )
 
+    def test_pipeline(self):
+        self.assertEqual(
+            yap_call([['printf', 'a\\nb\\n'], ['grep', 'b']], 'o'),
+            'b\n')
+        self.assertEqual(
+            yap_call([['cat'], ['tr', 'a', 'b'], ['cat']], 'o', 'aaa'),
+            'bbb')
+        # Errors of all commands
+        self.assertEqual(
+            yap_call([['sh', '-c', 'echo e1 >&2'],
+                      ['sh', '-c', 'cat; echo e2 >&2']], 'e'),
+            'e1\ne2\n')
+        # Errors merged in the output, not in the input of the next command
+        self.assertEqual(
+            yap_call([['sh', '-c', 'echo e1 >&2; echo data'],
+                      ['sh', '-c', 'tr a-z A-Z; echo e2 >&2']], 'O'),
+            'DATA\ne2\n')
+
+    def test_pipeline_fail(self):
+        # Like pipefail, the last failure
+        self.assertEqual(yap_call([['false'], ['true']], 'r'), 1)
+        self.assertEqual(
+            yap_call([['sh', '-c', 'exit 3'], ['false'], ['true']], 'r'), 1)
+        with self.assertRaises(CalledProcessError) as cm:
+            yap_call([['false'], ['cat']], 'o')
+        self.assertEqual(cm.exception.cmd, ['false'])
+        # Background
+        proc = yap_call([['echo', 'bg'], ['cat']], 'op')
+        self.assertEqual(proc.communicate(), ('bg\n', None))
+        self.assertEqual(proc.returncode, 0)
+
+    def test_stream_lines(self):
+        lines = yap_call(['printf', 'a\\nb\\n'], 'oL')
+        self.assertEqual(next(lines), 'a')
+        self.assertEqual(list(lines), ['b'])
+        self.assertEqual(
+            list(yap_call(['seq', '3'], 'oL', None, map_lines(int))),
+            [1, 2, 3])
+        self.assertEqual(
+            list(yap_call([['cat'], ['cat']], 'oL', 'x\ny')), ['x', 'y'])
+        # Checked at the end
+        lines = yap_call(['sh', '-c', 'echo a; exit 2'], 'oL')
+        self.assertEqual(next(lines), 'a')
+        with self.assertRaises(CalledProcessError):
+            next(lines)
+        # Stop early
+        lines = yap_call(['yes'], 'oL')
+        self.assertEqual(next(lines), 'y')
+        lines.close()
+
+    def test_stream_input(self):
+        numbers = (str(i) + '\n' for i in (3, 1, 2))
+        self.assertEqual(yap_call(['sort'], 'o', numbers), '1\n2\n3\n')
+        self.assertEqual(yap_call(['cat'], 'o', [b'a', 'b']), 'ab')
+        self.assertEqual(yap_call(['cat'], 'bo', [b'a', 'b']), b'ab')
+        # Big input and output at the same time
+        lines = ('x' * 1000 + '\n' for _ in range(1000))
+        self.assertEqual(len(yap_call(['cat'], 'o', lines)), 1001000)
+        self.assertEqual(
+            list(yap_call([['cat'], ['tr', 'a', 'b']], 'oL', iter('aa'))),
+            ['bb'])
+
+        def failing():
+            yield 'a'
+            raise ValueError('Input error')
+        with self.assertRaises(ValueError):
+            yap_call(['cat'], 'o', failing())
+
+    def test_jobs(self):
+        with Jobs(2) as jobs:
+            for i in range(4):
+                yap_call(['echo', str(i)], 'op', None, int)
+        self.assertEqual(jobs.results, [0, 1, 2, 3])
+        self.assertEqual(job_groups, [])
+        # Outside of a group, p! is a process
+        proc = yap_call(['true'], 'p')
+        self.assertEqual(proc.wait(), 0)
+
+    def test_jobs_max(self):
+        import time
+        running = [0, 0]  # Now, max
+
+        def work(i):
+            running[0] += 1
+            running[1] = max(running)
+            time.sleep(0.02)
+            running[0] -= 1
+            return i * 2
+
+        self.assertEqual(Jobs(3).map(work, range(10)), list(range(0, 20, 2)))
+        self.assertEqual(running[1], 3)
+
+    def test_jobs_errors(self):
+        with self.assertRaises(JobsError) as cm:
+            with Jobs() as jobs:
+                yap_call(['false'], 'p')
+                job = yap_call(['true'], 'p')
+                yap_call(['sh', '-c', 'exit 2'], 'p')
+        self.assertEqual(
+            [e.returncode for e in cm.exception.errors], [1, 2])
+        self.assertTrue(all(
+            isinstance(e, CalledProcessError) for e in cm.exception.errors))
+        self.assertIsNone(job.result())
+
+    def test_par_for(self):
+        self.assertEqual(
+            par_for(lambda x: x * 2, range(5), max_jobs=2), [0, 2, 4, 6, 8])
+        self.assertEqual(
+            par_for(lambda a, b: a + b, [(1, 2), (3, 4)], star=True), [3, 7])
+        started = []
+
+        def body(x):
+            started.append(x)
+            yap_call(['sh', '-c', 'exit {}'.format(x)])
+
+        with self.assertRaises(CalledProcessError) as cm:
+            par_for(body, [0, 3, 2, 0, 0, 0], max_jobs=1)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(started, [0, 3])
+        # Not lost in the thread
+        with self.assertRaises(SystemExit):
+            par_for(sys.exit, [0, 'failed'])
+
+    def test_acall(self):
+        import asyncio
+
+        async def calls():
+            outs = await asyncio.gather(
+                yap_acall(['echo', 'a'], 'o'),
+                yap_acall([['seq', '3'], ['tr', '\\n', ' ']], 'o'),
+                yap_acall(['cat'], 'o', iter(['x\n', b'y\n']), str.split),
+                yap_acall(['sh', '-c', 'echo err >&2; exit 3'], 'er'),
+                yap_acall([['sh', '-c', 'echo e1 >&2; echo data'],
+                           ['sh', '-c', 'tr a-z A-Z; echo e2 >&2']], 'O'))
+            lines = await yap_acall(['seq', '3'], 'oL', None, int)
+            outs.append([line async for line in lines])
+            with self.assertRaises(CalledProcessError) as cm:
+                await yap_acall([['false'], ['true']], '')
+            outs.append(cm.exception.cmd)
+            return outs
+
+        self.assertEqual(asyncio.run(calls()), [
+            'a\n', '1 2 3 ', ['x', 'y'], ['err\n', 3], 'DATA\ne2\n',
+            [1, 2, 3], ['false']])
+
+        # With hooks, and posix_spawn
+        profiler = Profiler()
+        yaphooks.add(profiler)
+
+        async def hooked():
+            await yap_acall(['echo', 'a'], 'ox')
+            await yap_acall([['seq', '3'], ['false']], 'n')
+            lines = await yap_acall(['seq', '2'], 'oL')
+            self.assertEqual([line async for line in lines], ['1', '2'])
+            proc = await yap_acall(['true'], 'p')
+            await proc.wait()
+            for _ in range(100):  # Until its exit hooks ran
+                if len(profiler.sites) == 4:
+                    break
+                await asyncio.sleep(0.01)
+            with Jobs():
+                with self.assertRaises(ValueError):
+                    yap_acall(['true'], 'p')
+        try:
+            asyncio.run(hooked())
+        finally:
+            yaphooks.remove(profiler)
+        sites = sorted(profiler.sites.values(), key=lambda s: s['command'])
+        self.assertEqual(
+            [(s['command'], s['exit_codes']) for s in sites],
+            [('echo a', {'0': 1}), ('seq 2', {'0': 1}),
+             ('seq 3 | false', {'1': 1}), ('true', {'0': 1})])
+        self.assertEqual(sites[0]['bytes_out'], 2)
+        self.assertIn('test_lib.py:', sites[0]['site'])
+
+    def test_grep(self):
+        lines = ['a b\n', '\n', 'b\n', 'c\n', 'ab']
+        with tempfile.NamedTemporaryFile('w', delete=False) as f:
+            f.write(''.join(lines))
+        try:
+            for regex in ('b', '^b', 'b$', '^$', r'a\sb', r'\Ab', r'b\Z'):
+                expected = [line for line in lines if re.search(regex, line)]
+                with open(f.name) as text:
+                    self.assertEqual(list(grep(regex, text)), expected)
+                with open(f.name, 'rb') as binary:
+                    self.assertEqual(
+                        list(grep(regex.encode(), binary)),
+                        [line.encode() for line in expected])
+            self.assertEqual(
+                list(grep('a', 'a b\nb\nab')), ['a b', 'ab'])
+        finally:
+            os.remove(f.name)
+
+    def test_grep_files(self):
+        global grep_chunk_size
+        contents = ['a\nb\nab\n\nba', '', 'xb\n' * 10]
+        paths = []
+        for content in contents:
+            with tempfile.NamedTemporaryFile('w', delete=False) as f:
+                f.write(content)
+            paths.append(f.name)
+        expected = [
+            (path, number, line)
+            for path, content in zip(paths, contents)
+            for number, line in enumerate(content.splitlines(), 1)
+            if 'b' in line]
+        chunk_size, grep_chunk_size = grep_chunk_size, 4
+        try:
+            for workers in (1, 3):
+                self.assertEqual(
+                    list(grep_files('b', paths, workers)), expected)
+            self.assertEqual(
+                list(grep_files(b'^a', paths[:1], 2)),
+                [(paths[0], 1, b'a'), (paths[0], 3, b'ab')])
+        finally:
+            grep_chunk_size = chunk_size
+            for path in paths:
+                os.remove(path)
+
+    def test_csv(self):
+        text = 'a,b\n1,"x, y"\n,z\n'
+        self.assertEqual(
+            csv_rows(text), [['a', 'b'], ['1', 'x, y'], ['', 'z']])
+        self.assertEqual(
+            csv_rows(text, [None, str.upper]),
+            [['a', 'B'], ['1', 'X, Y'], ['', 'Z']])
+        rows = csv_dicts(iter(text.splitlines()), {'a': int})
+        self.assertEqual(next(rows), {'a': 1, 'b': 'x, y'})
+        self.assertEqual(list(rows), [{'a': None, 'b': 'z'}])
+        self.assertEqual(
+            list(yap_call(['printf', text], 'oL', None, csv_dicts)),
+            [{'a': '1', 'b': 'x, y'}, {'a': '', 'b': 'z'}])
+        # Quoted fields on several lines, like in exports of psql --csv
+        self.assertEqual(
+            list(yap_call(['printf', 'a,"x\ny"\nb,z\n'], 'cLo', None,
+                          csv_rows)),
+            [['a', 'x\ny'], ['b', 'z']])
+        self.assertEqual(
+            list(yap_call(['printf', 'a,b\n1,"x\ny"\n'], 'CLo', None,
+                          csv_dicts)),
+            [{'a': '1', 'b': 'x\ny'}])
+
+    def test_json_lines(self):
+        lines = iter(['{"a": 1}', '', '[2]', '{]'])
+        docs = json_lines(lines)
+        self.assertEqual(next(docs), {'a': 1})
+        self.assertEqual(next(docs), [2])
+        with self.assertRaises(ValueError) as cm:
+            next(docs)
+        self.assertIn('line 4, column 2', str(cm.exception))
+
+    def test_table(self):
+        table = Table.parse(
+            'PID  RSS COMMAND\n'
+            '1    300 init\n'
+            '20  1000 sh -c true\n'
+            '\n'
+            '3\n')
+        self.assertEqual(table.names, ['PID', 'RSS', 'COMMAND'])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table['COMMAND'], ['init', 'sh -c true', ''])
+        self.assertEqual(list(table.ints('PID')), [1, 20, 3])
+        self.assertEqual(table.ints(0).typecode, 'q')
+        self.assertEqual(
+            list(table.where('COMMAND', bool).select('RSS', 'PID')),
+            [('300', '1'), ('1000', '20')])
+        by_pid = table.sort_by('PID', reverse=True, numeric=True)
+        self.assertEqual(list(by_pid.ints('PID')), [20, 3, 1])
+        self.assertEqual(by_pid['RSS'], ['1000', '', '300'])
+        # Empty fields
+        self.assertEqual(list(table.ints('RSS')), [300, 1000, 0])
+        self.assertEqual(
+            list(table.sort_by('RSS', numeric=True)['PID']), ['1', '20', '3'])
+        self.assertEqual(len(Table.parse('')), 0)
+        # Lines of a file, with their end
+        table = Table.parse(['PID COMMAND\n', '1 sh -c true  \n'])
+        self.assertEqual(table['COMMAND'], ['sh -c true'])
+
+    def test_spill(self):
+        expected = ''.join('{}\n'.format(i) for i in range(1, 101))
+        threshold, yapconfig.spill_threshold = yapconfig.spill_threshold, 50
+        try:
+            self.assertEqual(yap_call(['seq', '3'], 'oM'), '1\n2\n3\n')
+            out, err = yap_call(
+                [['seq', '100'], ['sh', '-c', 'cat; echo e >&2']], 'oeM')
+            self.assertIsInstance(out, SpilledOutput)
+            self.assertEqual(err, 'e\n')
+            self.assertEqual(str(out), expected)
+            self.assertEqual(len(out), len(expected))
+            self.assertIn('\n99\n', out)
+            self.assertEqual(list(out)[:2], ['1\n', '2\n'])
+            self.assertEqual(out.splitlines(), expected.splitlines())
+            with out.mmap() as data:
+                self.assertEqual(data[:4], b'1\n2\n')
+            self.assertEqual(
+                yap_call(['seq', '100'], 'oM', None, splitfields),
+                expected.split())
+            binary = yap_call(['seq', '100'], 'obM')
+            self.assertEqual(bytes(binary), expected.encode())
+            # The same as the output in memory
+            self.assertEqual(out, expected)
+            self.assertNotEqual(out, expected + 'x')
+            self.assertEqual(hash(out), hash(expected))
+            self.assertEqual(binary, expected.encode())
+            self.assertNotEqual(binary, b'1')
+            self.assertEqual(out.strip(), expected.strip())
+            self.assertTrue(out.startswith('1\n2\n'))
+            self.assertEqual(out.count('\n'), 100)
+            self.assertEqual(out[-4:], '100\n')
+            self.assertEqual(binary[-4:], b'100\n')
+            self.assertEqual(binary[0], ord('1'))
+            self.assertEqual(out + 'x', expected + 'x')
+            self.assertEqual('x' + out, 'x' + expected)
+            self.assertEqual(out.split('\n', 1), expected.split('\n', 1))
+            self.assertEqual(
+                [line.rstrip() for line in grep('^9', out)],
+                list(grep('^9', expected)))
+            for convert in (csv_rows, csv_dicts, split_lines_fields):
+                self.assertEqual(
+                    yap_call(['seq', '100'], 'oM', None, convert),
+                    convert(expected))
+            name = out.name
+            out.close()
+            self.assertFalse(os.path.exists(name))
+        finally:
+            yapconfig.spill_threshold = threshold
+
+    def test_bytes(self):
+        text = b'a b\n\xe9\n'
+        self.assertEqual(
+            yap_call(['cat'], 'ob', text, splitlines), [b'a b', b'\xe9'])
+        self.assertEqual(
+            yap_call(['cat'], 'ob', text, split_lines_fields),
+            [[b'a', b'b'], [b'\xe9']])
+        self.assertEqual(
+            list(yap_call(['cat'], 'obL', text, map_lines(splitfields))),
+            [[b'a', b'b'], [b'\xe9']])
+        self.assertEqual(list(grep(b'b', text)), [b'a b'])
+        with self.assertRaises(UnicodeDecodeError):
+            yap_call(['cat'], 'o', text)
+        yapconfig.encoding, yapconfig.errors = 'utf-8', 'replace'
+        try:
+            self.assertEqual(yap_call(['cat'], 'o', text), 'a b\n\ufffd\n')
+            yapconfig.encoding = 'latin-1'
+            self.assertEqual(yap_call(['cat'], 'o', text), 'a b\n\xe9\n')
+        finally:
+            yapconfig.encoding = yapconfig.errors = None
+
+    def test_posix_spawn(self):
+        spawned = []
+        real_posix_spawn = os.posix_spawn
+
+        def posix_spawn(path, argv, env, **kwargs):
+            spawned.append(argv)
+            return real_posix_spawn(path, argv, env, **kwargs)
+
+        os.posix_spawn = posix_spawn
+        try:
+            self.assertEqual(yap_call(['echo', 'a'], 'ox'), 'a\n')
+            self.assertEqual(
+                yap_call([['seq', '3'], ['tail', '-1']], 'ox'), '3\n')
+            self.assertEqual(yap_call(['printenv'], 'ovx'), '')
+            with self.assertRaises(OSError):
+                yap_call(['/nonexistent/command'], 'x')
+            yapconfig.spawn = 'posix_spawn'
+            self.assertEqual(yap_call(['echo', 'b'], 'os'), 'b\n')
+        finally:
+            os.posix_spawn = real_posix_spawn
+            yapconfig.spawn = 'fork'
+        self.assertEqual(spawned, [
+            ['echo', 'a'], ['seq', '3'], ['tail', '-1'], ['printenv'],
+            ['/nonexistent/command'], ['/bin/sh', '-c', 'echo b']])
+
+    def test_require(self):
+        yap_require(['sh', 'true'])
+        with self.assertRaises(SystemExit) as raised:
+            yap_require(['sh', 'no-such-program', 'nor-this-one'])
+        self.assertEqual(
+            str(raised.exception),
+            'Programs not found: no-such-program, nor-this-one')
+
+    def test_coshell(self):
+        self.assertEqual(yap_call(['printf', 'a b'], 'ko'), 'a b')
+        self.assertEqual(yap_call(['echo', "it's"], 'ko'), "it's\n")
+        self.assertEqual(
+            yap_call([['seq', '3'], ['tail', '-1']], 'ko'), '3\n')
+        self.assertEqual(yap_call(['test', '-e', '/'], 'kr'), 0)
+        self.assertEqual(yap_call(['false'], 'kr'), 1)
+        with self.assertRaises(CalledProcessError):
+            yap_call(['false'], 'k')
+        self.assertEqual(
+            yap_call(['seq', '3'], 'ko', None, split_lines_fields),
+            [['1'], ['2'], ['3']])
+        self.assertEqual(list(yap_call(['seq', '2'], 'koL')), ['1', '2'])
+        self.assertEqual(yap_call(['cat'], 'ko', 'input'), 'input')
+        shared = coshells[-1]
+        with Coshell() as sh:
+            self.assertIs(coshells[-1], sh)
+            yap_call(['cd', '/'], 'ks')
+            self.assertEqual(yap_call(['pwd'], 'ko'), '/\n')
+            with self.assertRaises(CalledProcessError):
+                yap_call(['exit', '3'], 'ks')
+            self.assertEqual(yap_call(['pwd'], 'ko'), os.getcwd() + '\n')
+        self.assertIs(coshells[-1], shared)
+        self.assertIsNone(sh.proc)
+
+        with Coprocess(['sh', '-c', 'while read l; do echo "<$l>"; done']) as co:
+            self.assertEqual(co.ask('a b'), '<a b>')
+            self.assertEqual(co.ask(''), '<>')
+        self.assertIsNone(co.proc)
+
+    def test_hooks(self):
+        self.assertFalse(yaphooks)
+        events = []
+
+        class Sink(object):
+            def before_spawn(self, call):
+                events.append(('before_spawn', call.cmd, call.proc))
+
+            def after_exit(self, call):
+                events.append(('after_exit', call.returncode, call.bytes_out))
+
+            def on_error(self, call):
+                events.append(('on_error', type(call.error).__name__))
+
+        sink = Sink()
+        yaphooks.add(sink)
+        try:
+            self.assertEqual(yap_call(['echo', 'a'], 'o'), 'a\n')
+            with self.assertRaises(CalledProcessError):
+                yap_call(['false'])
+            with self.assertRaises(OSError):
+                yap_call(['/nonexistent/command'])
+            list(yap_call(['seq', '2'], 'oL'))
+        finally:
+            yaphooks.remove(sink)
+        self.assertFalse(yaphooks)
+        self.assertEqual(events, [
+            ('before_spawn', ['echo', 'a'], None),
+            ('after_exit', 0, 2),
+            ('before_spawn', ['false'], None),
+            ('after_exit', 1, 0),
+            ('on_error', 'CalledProcessError'),
+            ('before_spawn', ['/nonexistent/command'], None),
+            ('on_error', 'FileNotFoundError'),
+            ('before_spawn', ['seq', '2'], None),
+            ('after_exit', 0, 0),
+        ])
+
+    def test_metrics(self):
+        metrics = Metrics()
+        yaphooks.add(metrics)
+        try:
+            yap_call([['/bin/echo', 'a'], ['cat']], 'o')
+            yap_call(['false'], 'n')
+            with self.assertRaises(OSError):
+                yap_call(['/nonexistent/command'])
+        finally:
+            yaphooks.remove(metrics)
+        text = metrics.text()
+        self.assertIn('yap_commands_total{command="echo|cat"} 1\n', text)
+        self.assertIn('yap_command_failures_total{command="false"} 1\n', text)
+        self.assertIn('yap_command_failures_total{command="command"} 1\n',
+                      text)
+        self.assertIn('yap_command_seconds_count{command="false"} 1\n', text)
+        self.assertIn(
+            'yap_command_cpu_seconds_total{command="echo|cat",mode="user"}',
+            text)
+        output = os.path.join(tempfile.mkdtemp(), 'yap.prom')
+        metrics.write(output)
+        with open(output) as f:
+            self.assertEqual(f.read(), text)
+
+    def test_profile(self):
+        profiler = Profiler()
+        yaphooks.add(profiler)
+        try:
+            for i in range(2):
+                yap_call(['cat'], 'o', 'abc')
+            yap_call([['seq', '3'], ['false']], 'n')
+            self.assertEqual(list(yap_call(['seq', '2'], 'oL')), ['1', '2'])
+        finally:
+            yaphooks.remove(profiler)
+        cat, seq, false = sorted(
+            profiler.sites.values(), key=lambda s: s['command'])
+        self.assertEqual(cat['command'], 'cat')
+        self.assertEqual(cat['calls'], 2)
+        self.assertEqual((cat['bytes_in'], cat['bytes_out']), (6, 6))
+        self.assertEqual(cat['exit_codes'], {'0': 2})
+        self.assertIn('test_lib.py:', cat['site'])
+        self.assertEqual(false['command'], 'seq 3 | false')
+        self.assertEqual(false['exit_codes'], {'1': 1})
+        self.assertEqual(seq['exit_codes'], {'0': 1})
+
+        output = os.path.join(tempfile.mkdtemp(), 'profile.json')
+        profiler.report(output)
+        with open(output) as f:
+            self.assertEqual(len(json.load(f)), 3)
+
+    def test_trace(self):
+        tracer = Tracer()
+        yaphooks.add(tracer)
+        try:
+            yap_call([['seq', '3'], ['cat']], 'o')
+            yap_call(['sleep', '0.01'], 'p').wait()
+        finally:
+            yaphooks.remove(tracer)
+        output = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        tracer.report(output)
+        with open(output) as f:
+            events = json.load(f)['traceEvents']
+        processes = [e for e in events if e.get('cat') == 'process']
+        self.assertEqual(
+            sorted(e['args']['command'] for e in processes),
+            ['cat', 'seq 3', 'sleep 0.01'])
+        for e in processes:
+            self.assertEqual(e['args']['status'], 0)
+            self.assertIn('test_lib.py:', e['args']['site'])
+            self.assertGreaterEqual(e['dur'], 0)
+        calls = [e['name'] for e in events if e.get('cat') == 'call']
+        self.assertEqual(calls, ['seq 3 | cat', 'sleep 0.01'])
+        self.assertIn('python', [e['name'] for e in events])
+
+    def test_background_hooks(self):
+        profiler, tracer, metrics = Profiler(), Tracer(), Metrics()
+        for sink in (profiler, tracer, metrics):
+            yaphooks.add(sink)
+        try:
+            yap_call(['sleep', '0.05'], 'p').wait()
+            for _ in range(100):  # The hooks run in a thread
+                if profiler.sites:
+                    break
+                time.sleep(0.01)
+            running = yap_call(['sleep', '10'], 'p')
+            # Reported at exit, still running
+            profiler.report()
+            text = metrics.text()
+            output = os.path.join(tempfile.mkdtemp(), 'trace.json')
+            tracer.report(output)
+        finally:
+            for sink in (profiler, tracer, metrics):
+                yaphooks.remove(sink)
+            running.kill()
+            running.wait()
+        done, still = sorted(
+            profiler.sites.values(), key=lambda s: s['command'])
+        self.assertEqual(done['command'], 'sleep 0.05')
+        self.assertEqual(done['exit_codes'], {'0': 1})
+        self.assertGreaterEqual(done['wall'], 0.05)
+        self.assertEqual(still['exit_codes'], {'running': 1})
+        self.assertIn('yap_commands_total{command="sleep"} 2\n', text)
+        self.assertIn('yap_command_failures_total{command="sleep"} 0\n', text)
+        with open(output) as f:
+            events = json.load(f)['traceEvents']
+        calls = [e['name'] for e in events if e.get('cat') == 'call']
+        self.assertEqual(calls, ['sleep 0.05', 'sleep 10'])
+        processes = [e['args'] for e in events if e.get('cat') == 'process']
+        self.assertEqual(processes[0]['command'], 'sleep 0.05')
+        self.assertEqual(processes[0]['status'], 0)
+
     def test_expand_env_soft(self):
         class O(object):
             pass
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import unittest
+import os
 import sys
+import tempfile
+import time
 sys.path.append('.')
 from pprint import pprint
 
@@ -53,15 +56,65 @@ class Test(unittest.TestCase):
         parsed = yap.split_bang(yp)
         pprint(list(parsed))
 
-    def test_re_symbols_bang_close(self):
-        data = [
-            ('', ['']),
-            ('random stuffs', ['']),
-            ('random stuffs\nnext line', ['', '']),
-            ('opening {\nclosing }', ['{', '', '}', '']),
-            ('stuff\n closing ) ', ['', ')', '']),
-        ]
-        self.check_regex(yap.re_symbols_bang_close, data)
+    def test_split_bang_parts(self):
+        yp = B('''x = (l! ls {a}) + 1  # c!
+("in" > ! wc "a b"
+  -l)
+y = S!S != D!D
+! echo {D}D} ok
+''')
+        self.assertEqual(list(yap.split_bang(yp)), [
+            ('x = (', '', 'l!', ' ls {a}'),
+            (B(') + 1  # c!N'), None, None, None),
+            ('(', B('DinD > '), '!', B(' wc Da bDN  -l')),
+            (B(')N'), None, None, None),
+            (B('y = S!S != D!DN'), None, None, None),
+            ('', '', '!', B(' echo {D}D} ok')),
+            (B('N'), None, None, None),
+        ])
+
+    def test_parse_cmd(self):
+        self.assertEqual(
+            yap.parse_cmd(B('echo DitSs {x} aD $1 {{1: 2}[1]}x >  out'), ''),
+            [
+                ('echo', []),
+                (B('DitSs {} aD'), ['{x}']),
+                ('{}', ['$1']),
+                ('{}x', ['{{1: 2}[1]}']),
+                ('out', '>'),
+            ])
+        self.assertEqual(
+            yap.parse_cmd('echo $1 | cat', 's'),
+            [('echo', []), ('$1', []), ('|', []), ('cat', [])])
+
+    def test_syntax_errors(self):
+        # Dangling quote, instead of quoting the rest of the file
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_yap("x = 1\n! echo it's\nprint(1)\n", None, 'f.yp')
+        e = raised.exception
+        self.assertEqual(
+            (e.msg, e.filename, e.lineno, e.offset, e.text),
+            ('"\'" was never closed', 'f.yp', 2, 10, "! echo it's"))
+        # Brackets, on the lines of the source
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_yap(
+                'par for x in y:\n    pass\n(! echo a\n  {b} {c[0}\n  d)\n')
+        e = raised.exception
+        self.assertEqual(
+            (e.msg, e.lineno, e.offset), ("'[' was never closed", 4, 9))
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_yap("(! echo a\n  '{b'\n  d)\n")
+        self.assertEqual(
+            (raised.exception.lineno, raised.exception.offset), (2, 4))
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_yap('! echo $(a\n')
+        self.assertEqual(raised.exception.offset, 9)
+        # In linear time
+        start = time.time()
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_yap("! echo '" + '{' * 10000 + "'\n")
+        self.assertEqual(raised.exception.offset, 10008)
+        self.assertLess(time.time() - start, 1)
 
     def test_escape_py(self):
         data = [
@@ -79,6 +132,411 @@ class Test(unittest.TestCase):
                 B(escaped),
             )
 
+    def test_compile_pipeline(self):
+        self.assertEqual(
+            yap.compile_sh('', '!', 'ls {x} | grep "a|b" |wc > out', True),
+            'yap_call([["ls", str(x)], ["grep", "a|b"], ["wc"]], "o", '
+            '(None), None, open(out, "w"))')
+        self.assertEqual(
+            yap.compile_sh('', 's!', 'ls | wc', False),
+            'yap_call(["ls", "|", "wc"], "s", (None), None, None)')
+        with self.assertRaises(SyntaxError):
+            yap.compile_sh('', '!', 'ls || wc', False)
+
+    def test_compile_stream(self):
+        self.assertEqual(
+            yap.compile_sh('', 'iL!', 'seq 3', False),
+            'yap_call(["seq", "3"], "iLo", (None), map_lines(int), None)')
+        with self.assertRaises(SyntaxError):
+            yap.compile_sh('', 'jL!', 'seq 3', False)
+        self.assertEqual(
+            yap.compile_sh('', 'CL!', 'cat x.csv', False),
+            'yap_call(["cat", "x.csv"], "CLo", (None), csv_dicts, None)')
+        self.assertEqual(yap.flags_to_function('oc'), 'csv_rows')
+        self.assertEqual(yap.flags_to_function('ot'), 'Table.parse')
+        self.assertEqual(yap.flags_to_function('olM'), 'splitlines')
+        self.assertEqual(yap.flags_to_function('obf'), 'splitfields')
+        self.assertEqual(
+            yap.flags_to_function('obLf'), 'map_lines(splitfields)')
+        with self.assertRaises(SyntaxError):
+            yap.flags_to_function('obc')
+        self.assertEqual(
+            yap.compile_sh('', 'J!', 'docker events', True),
+            'yap_call(["docker", "events"], "JoL", (None), json_lines, None)')
+
+    def test_compile_async(self):
+        self.assertEqual(
+            yap.compile_sh('', 'a!', 'true', False),
+            'yap_acall(["true"], "a", (None), None, None)')
+        with self.assertRaises(SyntaxError):
+            yap.compile_sh('', 'aM!', 'cat big', False)
+        with self.assertRaises(SyntaxError):
+            yap.compile_sh('', 'ak!', 'true', False)
+        yap.async_calls = True
+        try:
+            self.assertEqual(
+                yap.compile_sh('', 'x!', 'true', False),
+                '(await yap_acall(["true"], "xa", (None), None, None))')
+            # Processes, jobs and lines, that for loops iterate on
+            self.assertEqual(
+                yap.compile_sh('', 'iL!', 'seq 3', False),
+                'yap_call(["seq", "3"], "iLo", (None), map_lines(int), None)')
+            self.assertEqual(
+                yap.compile_sh('', 'p!', 'sleep 1', False),
+                'yap_call(["sleep", "1"], "p", (None), None, None)')
+            self.assertEqual(
+                yap.compile_sh('', 'k!', 'true', False),
+                'yap_call(["true"], "k", (None), None, None)')
+            self.assertEqual(
+                yap.expand_python(
+                    'def f():\n'
+                    '    return (! echo x)\n'
+                    'async def g():\n'
+                    '    ! true\n'),
+                'def f():\n'
+                '    return (yap_call(["echo", "x"], "o", (None), None, None))\n'
+                'async def g():\n'
+                '    (await yap_acall(["true"], "a", (None), None, None))\n')
+            pycode = yap.compile_yap('par for n in [1, 2]:\n    ! echo {n}\n')
+            self.assertIn('    yap_call(["echo", str(n)]', pycode)
+        finally:
+            yap.async_calls = False
+
+    def test_compile_programs(self):
+        programs = []
+        yap.compile_sh('', '!', 'ls {x} | ./run.sh | {cmd} a', True, programs)
+        yap.compile_sh('', 's!', 'cd /', False, programs)
+        yap.compile_sh('', 'k!', 'cd /', False, programs)
+        yap.compile_sh('', '!', '"my prog" $1', False, programs)
+        self.assertEqual(programs, ['ls'])  # ./run.sh depends on the cwd
+
+        # Only with --check, for all the commands that may run
+        pycode = yap.compile_yap('! true')
+        self.assertNotIn('yap_require', pycode)
+        yap.check_programs = True
+        try:
+            pycode = yap.compile_yap('! true\n! true\n! false')
+            self.assertIn("yap_require(['false', 'true'])", pycode)
+            pycode = yap.compile_yap(
+                'if x:\n'
+                '    ! a\n'
+                'def f():\n'
+                '    ! b\n'
+                '    return (! c)\n'
+                'for x in y: ! d\n'
+                '! e\n')
+        finally:
+            yap.check_programs = False
+        self.assertIn("yap_require(['a', 'b', 'c', 'd', 'e'])", pycode)
+
+    def test_par_for(self):
+        self.assertEqual(
+            yap.expand_par_for(
+                'par for f in files:\n'
+                '    gz! {f}\n'
+                '\n'
+                'par(2) for (i, f) in enumerate(files):\n'
+                '    if i:\n'
+                '        pass\n'
+                'done()\n'),
+            'def _yap_par_for_1(f):\n'
+            '    gz! {f}\n'
+            'par_for(_yap_par_for_1, files)\n'
+            'def _yap_par_for_2(i, f):\n'
+            '    if i:\n'
+            '        pass\n'
+            'par_for(_yap_par_for_2, enumerate(files), max_jobs=2, star=True)\n'
+            'done()\n')
+        with self.assertRaises(SyntaxError):
+            yap.expand_par_for('par for x.y in z:\n    pass\n')
+        # Not in strings, where lines do not end the body either
+        source = ('doc = """\n'
+                  'par for x in y:\n'
+                  '"""\n')
+        self.assertEqual(yap.expand_par_for(source), source)
+        self.assertEqual(
+            yap.expand_par_for('par for x in y:\n'
+                               '    print("""a\n'
+                               'b""")\n'),
+            'def _yap_par_for_1(x):\n'
+            '    print("""a\n'
+            'b""")\n'
+            'par_for(_yap_par_for_1, y)\n')
+
+    def test_source_map(self):
+        source = (
+            'x = (! echo a\n'
+            '     b)\n'
+            'par for f in files:\n'
+            '    ! gzip {f}\n'
+            'y = 1\n')
+        source_map = []
+        pycode = yap.compile_yap(source, source_map)
+        self.assertEqual(len(source_map), pycode.count('\n') + 1)
+        header = source_map.count(None)
+        self.assertEqual(source_map[header:], [1, 2, 3, 4, 3, 5, 6])
+        lines = pycode.splitlines()
+        self.assertTrue(lines[header].startswith('x = (yap_call('))
+        self.assertEqual(lines[header + 5], 'y = 1')
+
+        runtime, script = yap.compile_py(pycode, 'map.yp', source_map)
+        self.assertEqual(runtime.co_filename, '<yap runtime>')
+
+        source_map = []
+        pycode = yap.compile_yap('x = 1\n\ny = (\n', source_map)
+        with self.assertRaises(SyntaxError) as raised:
+            yap.compile_py(pycode, 'map.yp', source_map)
+        self.assertEqual(raised.exception.lineno, 3)
+        self.assertEqual(
+            set(line for _, _, line in script.co_lines() if line),
+            set([1, 3, 5]))
+
+    def test_line_profiler(self):
+        source = 'x = 0\nfor i in range(3):\n    x += 1\n! true\n'
+        source_map = []
+        yap.inline_libs = True
+        try:
+            pycode = yap.compile_yap(source, source_map)
+        finally:
+            yap.inline_libs = False
+        runtime, script = yap.compile_py(pycode, 'prof.yp', source_map)
+        script_globals = yap.make_globals('prof.yp')
+        exec(runtime, script_globals)
+        profiler = yap.LineProfiler('prof.yp', source)
+        sys.settrace(profiler.trace)
+        try:
+            exec(script, script_globals)
+        finally:
+            profiler.stop()
+        self.assertEqual(sorted(profiler.lines), [1, 2, 3, 4])
+        self.assertEqual(profiler.lines[3][0], 3)
+        self.assertGreater(profiler.lines[4][1], 0)
+
+    def test_used_libs(self):
+        self.assertEqual(yap.used_libs('x = 1 + 1'), [])
+        self.assertEqual(yap.used_libs('x.exit(stdin=1)'), [])
+        self.assertEqual(yap.used_libs('print(sys.argv)'), ['import sys'])
+        # Dependencies of libraries
+        libs = yap.used_libs('yap_call(["ls"], "o", None, None, None)')
+        self.assertIn(yap.call_lib, libs)
+        self.assertIn('import re', libs)
+        self.assertNotIn(yap.logging_lib, libs)
+        self.assertNotIn('from sys import stdin, stdout, stderr, exit', libs)
+
+    def test_libs_requires(self):
+        " The globals that libraries read are the names they say they use "
+        import builtins
+        import symtable
+
+        def read_globals(table):
+            names = set(
+                symbol.get_name() for symbol in table.get_symbols()
+                if symbol.is_referenced() and (
+                    symbol.is_global() or table.get_type() == 'module'))
+            for child in table.get_children():
+                names.update(read_globals(child))
+            return names
+
+        defined_by_libs = set()
+        for names, _, _ in yap.libs:
+            defined_by_libs.update(names.split())
+        for names, uses, code in yap.libs:
+            table = symtable.symtable(code, names, 'exec')
+            defined = set(dir(builtins)) | {'__file__'} | set(
+                symbol.get_name() for symbol in table.get_symbols()
+                if symbol.is_assigned() or symbol.is_imported())
+            self.assertEqual(
+                read_globals(table) - defined, set(uses.split()), names)
+            self.assertLessEqual(set(uses.split()), defined_by_libs)
+
+    def test_yaplib(self):
+        source = 'print(! echo {listget([1], 0)})'
+        pycode = yap.compile_yap(source)
+        self.assertIn('from yaplib import listget, yap_call', pycode)
+        self.assertNotIn(yap.call_lib, pycode)
+        self.assertNotIn('import re', pycode)  # Only used by yaplib
+
+        yaplib = {}
+        exec(yap.yaplib_source(), yaplib)
+        for name in ('yap_call', 'listget', 'grep', 'red', 'missingget'):
+            self.assertIn(name, yaplib)
+        self.assertNotIn('logging', yaplib)
+
+        yap.inline_libs = True
+        try:
+            pycode = yap.compile_yap(source)
+        finally:
+            yap.inline_libs = False
+        self.assertNotIn('yaplib', pycode)
+        self.assertIn(yap.call_lib, pycode)
+
+    def test_compile_cached(self):
+        cache = tempfile.mkdtemp()
+        old_env = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache
+        try:
+            source = 'x = 1 + 1\n'
+            code = yap.compile_cached(source, 'cached.yp')
+            cached = os.listdir(os.path.join(cache, 'yap'))
+            self.assertEqual(len(cached), 2)  # .py and .code
+
+            # Warm run, loaded from the cache
+            self.assertEqual(yap.compile_cached(source, 'cached.yp'), code)
+            self.assertEqual(os.listdir(os.path.join(cache, 'yap')), cached)
+
+            # Different options, different entry
+            yap.dry_run = True
+            yap.compile_cached(source, 'cached.yp')
+            self.assertEqual(len(os.listdir(os.path.join(cache, 'yap'))), 4)
+
+            yap.evict_cache(os.path.join(cache, 'yap'), 0)
+            self.assertEqual(os.listdir(os.path.join(cache, 'yap')), [])
+        finally:
+            yap.dry_run = False
+            if old_env is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_env
+
+    def test_install_yaplib(self):
+        cache = tempfile.mkdtemp()
+        old_env = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache
+        libs_dir = os.path.join(cache, 'yap', 'lib')
+        old_path = list(sys.path)
+        try:
+            for version, age in (('recent', 3600), ('old', 365 * 86400)):
+                os.makedirs(os.path.join(libs_dir, version))
+                when = time.time() - age
+                os.utime(os.path.join(libs_dir, version), (when, when))
+            self.assertTrue(yap.install_yaplib())
+            self.assertEqual(sorted(os.listdir(libs_dir)),
+                             sorted([yap.compiler_hash(), 'recent']))
+
+            # yaplib removed by another yap: embed the runtime
+            sys.path.insert(0, os.path.join(cache, 'removed'))
+            sys.modules.pop('yaplib', None)
+            install_yaplib = yap.install_yaplib
+            yap.install_yaplib = lambda: True
+            script = os.path.join(cache, 'script.yp')
+            output = os.path.join(cache, 'output')
+            with open(script, 'w') as f:
+                f.write('with open($1, "w") as f:\n'
+                        '    f.write(o! echo inline)\n')
+            try:
+                yap.main([script, output])
+            finally:
+                yap.install_yaplib = install_yaplib
+                yap.inline_libs = False
+            with open(output) as f:
+                self.assertEqual(f.read(), 'inline\n')
+        finally:
+            sys.path[:] = old_path
+            sys.modules.pop('yaplib', None)
+            if old_env is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_env
+
+    def test_server(self):
+        import subprocess
+        import time
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'yap.sock')
+        yap_path = os.path.abspath('yap.py')
+        script = os.path.join(directory, 'script.yp')
+        with open(script, 'w') as f:
+            f.write('print($1, os.getcwd(), os.environ["WHO"],\n'
+                    '      os.getppid() == int(os.environ["SERVER"]))\n'
+                    '! cat\n'
+                    'sys.exit(3)\n')
+        umask = os.path.join(directory, 'umask.yp')
+        with open(umask, 'w') as f:
+            f.write('print(oct(os.umask(0)))\n')
+        modules = os.path.join(directory, 'modules')
+        os.mkdir(modules)
+        with open(os.path.join(modules, 'client_module.py'), 'w') as f:
+            f.write('name = "module"\n')
+        imports = os.path.join(directory, 'imports.yp')
+        with open(imports, 'w') as f:
+            f.write('import client_module\n'
+                    'print(client_module.name,\n'
+                    '      os.getppid() == int(os.environ["SERVER"]))\n')
+        colors = os.path.join(directory, 'colors.yp')
+        with open(colors, 'w') as f:
+            f.write('print(red("x"))\n')
+        yap.write_client(directory)
+        yapc = os.path.join(directory, 'yapc')
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, '__pycache__')))
+        # In a terminal, that is not the one of the clients
+        master, terminal = os.openpty()
+        server = subprocess.Popen(
+            [sys.executable, yap_path, '--server', path], stdout=terminal)
+        os.close(terminal)
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            env = dict(os.environ, YAP_SERVER=path, WHO='client',
+                       SERVER=str(server.pid))
+            client = subprocess.run(
+                [sys.executable, yap_path, script, 'arg'], cwd='/',
+                input=b'in\n', stdout=subprocess.PIPE, env=env)
+            self.assertEqual(client.stdout, b'arg / client True\nin\n')
+            self.assertEqual(client.returncode, 3)
+
+            client = subprocess.run(
+                [yapc, script, 'arg'], cwd='/',
+                input=b'in\n', stdout=subprocess.PIPE, env=env)
+            self.assertEqual(client.stdout, b'arg / client True\nin\n')
+            self.assertEqual(client.returncode, 3)
+
+            client = subprocess.run(
+                [yapc, umask], stdout=subprocess.PIPE, env=env,
+                preexec_fn=lambda: os.umask(0o27))
+            self.assertEqual(client.stdout, b'0o27\n')
+            client = subprocess.run(
+                [yapc, colors], stdout=subprocess.PIPE, env=env)
+            self.assertEqual(client.stdout, b'x\n')
+
+            # The modules of the client, other settings of Python locally
+            client = subprocess.run(
+                [yapc, imports], stdout=subprocess.PIPE,
+                env=dict(env, PYTHONPATH=modules))
+            self.assertEqual(client.stdout, b'module True\n')
+            client = subprocess.run(
+                [yapc, script, 'arg'], cwd='/',
+                input=b'in\n', stdout=subprocess.PIPE,
+                env=dict(env, PYTHONHASHSEED='1'))
+            self.assertEqual(client.stdout, b'arg / client False\nin\n')
+            self.assertEqual(client.returncode, 3)
+        finally:
+            server.terminate()
+            server.wait()
+            os.close(master)
+        self.assertFalse(os.path.exists(path))
+
+        # Without server, run in the client
+        client = subprocess.run(
+            [sys.executable, yap_path, script, 'arg'], cwd='/',
+            input=b'in\n', stdout=subprocess.PIPE, env=env)
+        self.assertEqual(client.stdout, b'arg / client False\nin\n')
+        self.assertEqual(client.returncode, 3)
+
+        client = subprocess.run(
+            [os.path.abspath('yap'), script, 'arg'], cwd='/',
+            input=b'in\n', stdout=subprocess.PIPE, env=env)
+        self.assertEqual(client.stdout, b'arg / client False\nin\n')
+        self.assertEqual(client.returncode, 3)
+
+        client = subprocess.run(
+            [yapc, script, 'arg'], cwd='/',
+            input=b'in\n', stdout=subprocess.PIPE, env=env)
+        self.assertEqual(client.stdout, b'arg / client False\nin\n')
+        self.assertEqual(client.returncode, 3)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -14,222 +14,283 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
 import sys
 import re
+import hashlib
+import marshal
 from itertools import starmap
 
 
 dry_run = False
+use_cache = True
+inline_libs = False  # Embed the runtime instead of importing yaplib
+async_calls = False  # Await all commands, in a script running in asyncio
+profile_lines = False  # Report the time spent on each line of the script
+check_programs = False  # Exit before the script if its programs are missing
+cache_max_size = 50 * 2**20  # Bytes of compiled scripts to keep
+yaplib_max_age = 30 * 24 * 3600  # Seconds to keep the yaplib of unused yaps
 
 # No colored output for now
 blue = gray = green = orange = red = _yap_color = lambda s, c='': s
 debug = lambda *args: None
 
 
-def parse_cmd(s, flags):
-    ''' Extract arguments from a shell command while parsing the {expressions}.
-        Return [ (argument, [expressions, ..]), .. ].
-    '''
-    parse_dollar = not 's' in flags
-    parts = []
-    current_part = ''
-    current_exprs = []
+## Lexing. Each function walks its input once, searching for the next
+## interesting token from where the previous one ended.
 
-    def finish_arg():
-        if current_part:
-            parts.append((current_part, current_exprs))
-        return '', []
-
-    after = s
-    while after:
-        before, expr, after = extract_next_space_or_py_expr(after, parse_dollar)
-        current_part += before
-        if expr is not None:
-            if expr == '>':
-                current_part, current_exprs = finish_arg()
-                parts.append((after.strip(), expr))
-                break  # All the rest is the output expression
-            elif expr.isspace():  # New argument
-                current_part, current_exprs = finish_arg()
-            else:  # An expression in the current argument
-                current_part += '{}'  # for format()
-                if expr == '{}':
-                    expr = '{"{}"}'  # Replace literal {} by itself
-                current_exprs.append(expr)
-    finish_arg()
-    return parts
+re_py_token = re.compile(r'''
+    (?P<quote> \'\'\' | """ | ['"] )
+  | (?P<comment> \# )
+  | (?P<open> [(\[{] )
+  | (?P<close> [)\]}] )
+  | (?P<bang> (?<!\w) \w*! (?!=) )   # flags!
+  | (?P<eol> \n )
+''', re.X)
 
+# The rest of a Python string after its opening quote, terminated or not
+re_py_string_end = {
+    "'": re.compile(r"[^'\\\n]* (?: \\. [^'\\\n]* )* '?", re.X | re.S),
+    '"': re.compile(r'[^"\\\n]* (?: \\. [^"\\\n]* )* "?', re.X | re.S),
+    "'''": re.compile(
+        r"[^'\\]* (?: (?: \\. | '(?!'') ) [^'\\]* )* (?:''')?", re.X | re.S),
+    '"""': re.compile(
+        r'[^"\\]* (?: (?: \\. | "(?!"") ) [^"\\]* )* (?:""")?', re.X | re.S),
+}
 
-def combine_re(res, flags=0):
-    return re.compile(
-        '({})'.format(
-            ')|('.join(res)),
-        flags)
-
-re_symbols_expr_open = combine_re([
-    r'(?: \s+ | \{ | > | \$)',   # Start capture
-    r'$x^',     # Ignore brackets (never matches)
-    r'$x^',     # Ignore brackets (never matches)
-    r'["\']',   # Quotes
-], re.X | re.MULTILINE)
-
-re_symbols_expr_close = combine_re([
-    r'\}',  # End capture
-    r'\{',     # Ignore other brackets
-    r'\}',     # Ignore other brackets
-    r'["\']',   # Quotes
-], re.X | re.MULTILINE)
-
-re_symbols_dollar_close = combine_re([
-    r'\w+',     # capture all alphanumeric characters
-    r'$x^',     # Ignore brackets (never matches)
-    r'$x^',     # Ignore brackets (never matches)
-    r'$x^',     # Ignore quotes (never matches)
-], re.X | re.MULTILINE)
-
-
-def extract_next_space_or_py_expr(s, parse_dollar=True):
-    ' Extract the next {python} or next argument from a shell command '
-    def ret(mopen, mclose):
-        return (
-            s[:mopen.start()],
-            s[mopen.start():mclose.end()],
-            s[mclose.end():],
-        )
+re_cmd_token = re.compile(r'''
+    (?P<quote> ['"] )
+  | (?P<open> [(\[{] )
+  | (?P<close> [)\]}] )
+  | (?P<eol> \n )
+''', re.X)
 
-    for mopen, quoted, stack in safe_search(re_symbols_expr_open, s):
-        if not mopen:
-            break
+re_arg_token = re.compile(r'''
+    (?P<space> \s+ )
+  | (?P<expr> \{ )
+  | (?P<dollar> \$\w+ )
+  | (?P<redirect> > )
+  | (?P<pipe> \| )
+  | (?P<quote> ['"] )
+''', re.X)
 
-        if mopen.group() == '{':
-            for mclose, close_quoted, close_stack in safe_search(
-                    re_symbols_expr_close, s, pos=mopen.end()):
 
-                close_depth = len(close_stack)
-                if mclose and not close_quoted and close_depth == 0:
-                    return ret(mopen, mclose)
+def skip_py_string(s, m):
+    ' Return the position after the string opened by the quote match m '
+    return re_py_string_end[m.group()].match(s, m.end()).end()
 
-        elif mopen.group() == '$':
-            if not parse_dollar:
-                continue
-            for mclose, close_quoted, close_stack in safe_search(
-                    re_symbols_dollar_close, s, pos=mopen.end()):
 
-                if mclose:
-                    return ret(mopen, mclose)
+def skip_comment(s, pos):
+    eol = s.find('\n', pos)
+    return len(s) if eol < 0 else eol
 
-        # The rest are not interpreted in quotes
-        elif quoted:
-            continue
 
-        elif mopen.group() == '>':
-            return ret(mopen, mopen)
-
-        else:  # Split around the spaces and return
-            return ret(mopen, mopen)
-
-        break  # Close not found, ignore. Could raise SyntaxError instead XXX
-    return s, None, ''  # Nothing found
-
-
-def safe_search(re_symbols, s, pos=0, openings='({[', closings=')}]'):
-    ' Like re.search() but aware of parenthesis, quotes, and escaping. '
-    #escaped = False  # XXX Support escaping
-    in_quotes = False
-    in_dquotes = False
-    quoted = False
-    stack = []
-
-    for m in re_symbols.finditer(s, pos):
-        c = m.group()
-        capture, opening, closing, quote = m.groups()
-        # Toggle quote state
-        if c == "'":
-            in_quotes = not in_quotes
-        elif c == '"':
-            in_dquotes = not in_dquotes
-        quoted = in_quotes or in_dquotes
-
-        if capture is not None:  # Found it
-            yield m, quoted, stack
-
-        if c and not quoted:
-            if c in openings:
-                stack.append(m)
-            elif c in closings and stack:
-                stack.pop()
+def syntax_error(msg, s, pos):
+    ' Return a SyntaxError at s[pos], with its line and column '
+    start = s.rfind('\n', 0, pos) + 1
+    end = s.find('\n', pos)
+    text = s[start:] if end < 0 else s[start:end]
+    return SyntaxError(msg, (None, s.count('\n', 0, pos) + 1, pos - start + 1,
+                             text))
 
-    yield None, quoted, stack  # Not found
 
+closing_brackets = {'(': ')', '[': ']', '{': '}'}
 
-## Looking for a (!) expression
-re_symbols_bang_open = combine_re([
-    r'\w*! (?! = )  |  \s* (?: \# .* )? $ ',   # Capture bang or EOL
-    r'\(',     # Count only parenthesis
-    r'\)',     # Count only parenthesis
-    r'["\']',  # Quotes
-], re.X | re.MULTILINE)
 
-re_symbols_bang_close = combine_re([
-    r' \)  |  $ ',   # Capture end or EOL
-    r'[({[]',     # Count all brackets
-    r'[)}\]]',    # Count all brackets
-    r'["\']',     # Quotes
-], re.X | re.MULTILINE)
+def never_closed(s, pos):
+    return syntax_error('{!r} was never closed'.format(s[pos]), s, pos)
+
+
+def match_py_bracket(s, pos):
+    ''' Return the position after the bracket closing the one at s[pos].
+        Skip strings and comments. Raise SyntaxError at the innermost bracket
+        not closed, or closed by another kind of bracket.
+    '''
+    opened = []  # Positions of the brackets not closed yet
+    while True:
+        m = re_py_token.search(s, pos)
+        if not m:
+            raise never_closed(s, opened[-1])
+        kind = m.lastgroup
+        pos = m.end()
+        if kind == 'quote':
+            pos = skip_py_string(s, m)
+        elif kind == 'comment':
+            pos = skip_comment(s, pos)
+        elif kind == 'open':
+            opened.append(m.start())
+        elif kind == 'close':
+            if m.group() != closing_brackets[s[opened[-1]]]:
+                raise never_closed(s, opened[-1])
+            opened.pop()
+            if not opened:
+                return pos
+
+
+def string_lines(s):
+    ' Return the numbers of the lines of s that start inside a string '
+    numbers = set()
+    number, counted = 1, 0  # Line number at position counted
+    pos = 0
+    while True:
+        m = re_py_token.search(s, pos)
+        if not m:
+            return numbers
+        kind = m.lastgroup
+        pos = m.end()
+        if kind == 'quote':
+            pos = skip_py_string(s, m)
+            number += s.count('\n', counted, m.start())
+            counted = m.start()
+            spanned = s.count('\n', m.start(), pos)
+            numbers.update(range(number + 1, number + spanned + 1))
+        elif kind == 'comment':
+            pos = skip_comment(s, pos)
 
 
 def split_bang(s):
-    ' Extract the next (..!...), yield (pure py, input, flags!, cmd) '
+    ''' Extract the next (..!...), yield (pure py, input, flags!, cmd).
+        Python strings and comments are skipped.
+    '''
     last_cut = 0
-
-    for mbang, open_quoted, open_stack in safe_search(re_symbols_bang_open, s):
-        if not mbang:
+    stack = []  # Brackets open in Python: (position after, bracket)
+    pos = 0
+    while True:
+        m = re_py_token.search(s, pos)
+        if not m:
             break
-        if open_quoted or mbang.start() < last_cut:
-            continue
+        kind = m.lastgroup
+        pos = m.end()
+
+        if kind == 'quote':
+            pos = skip_py_string(s, m)
+        elif kind == 'comment':
+            pos = skip_comment(s, pos)
+        elif kind == 'open':
+            stack.append((pos, m.group()))
+        elif kind == 'close':
+            if stack:
+                stack.pop()
+        elif kind == 'eol':
+            if not stack:  # End of statement
+                yield s[last_cut:pos], None, None, None
+                last_cut = pos
+        else:  # Found a bang, look for the end of the expression
+            # Format: input flags! cmd
+            bang_start = m.start()
+            cmd_start = pos
+            in_parens = bool(stack) and stack[-1][1] == '('
+            stop = find_cmd_end(s, cmd_start, in_parens)
+            if in_parens:  # Go back to opening (, don't include the ()
+                in_start = stack[-1][0]
+            else:  # Not in (), start at: flags! ...
+                in_start = bang_start
+            yield (
+                s[last_cut:in_start],
+                s[in_start:bang_start],
+                s[bang_start:cmd_start],
+                s[cmd_start:stop],
+            )
+            last_cut = pos = stop  # The closing bracket is Python again
+
+    if last_cut < len(s):
+        yield s[last_cut:], None, None, None
+
+
+def find_cmd_end(s, pos, in_parens):
+    ''' Return where the command starting at pos ends: at the closing ) if
+        in_parens, otherwise at the end of the line or of the enclosing
+        brackets. Brackets in the command can span lines, quotes cannot.
+        Raise SyntaxError at a quote or a bracket not closed, like in
+        match_py_bracket().
+    '''
+    opened = []  # Positions of the brackets not closed yet
+    while True:
+        m = re_cmd_token.search(s, pos)
+        if not m:
+            if opened:
+                raise never_closed(s, opened[-1])
+            return len(s)
+        kind = m.lastgroup
+        pos = m.end()
+        if kind == 'quote':
+            eol = s.find('\n', pos)
+            close = s.find(m.group(), pos, len(s) if eol < 0 else eol)
+            if close < 0:
+                raise never_closed(s, m.start())
+            pos = close + 1
+        elif kind == 'open':
+            opened.append(m.start())
+        elif opened:  # Nested bracket, or new line inside one
+            if kind == 'close':
+                if m.group() != closing_brackets[s[opened[-1]]]:
+                    raise never_closed(s, opened[-1])
+                opened.pop()
+        elif kind == 'close' or not in_parens:
+            return m.start()
 
-        matched = mbang.group()
-        if matched and matched[-1] == '!':
-            # Found a bang, look for the end of the expression
-            for mclose, close_quoted, close_stack in safe_search(
-                    re_symbols_bang_close, s, pos=mbang.end()
-            ):
-
-                # Candidate end
-                if not mclose or close_quoted or close_stack:
-                    continue  # Ignore if in quotes or in pending brackets
-                elif open_stack and mclose.group() != ')':
-                    continue  # We are in (! expr), wait for the closing bracket
-                else:
-                    # Found the end
-                    # Format: input flags! cmd
-                    bang_start = mbang.start()
-                    cmd_start = mbang.end()
-                    stop = mclose.start()
-                    if open_stack:  # Go back to opening (, don't include the ()
-                        in_start = open_stack[-1].end()
-                    else:  # Not in (), start at: flags! ...
-                        in_start = bang_start
-
-                    yield (
-                        s[last_cut:in_start],
-                        s[in_start:bang_start],
-                        s[bang_start:cmd_start],
-                        s[cmd_start:stop],
-                    )
-                    last_cut = stop
-                    break  # Done, look for next bang item
-
-        else:  # End-of-line
-            if not open_stack:  # End of statement
-                stop = mbang.end()
-                yield (
-                    s[last_cut:stop],
-                    None, None, None
-                )
-                last_cut = stop
-
-    assert last_cut == len(s), 'Did not consume all the source: <%s>' % s[last_cut:]
+
+def parse_cmd(s, flags):
+    ''' Extract arguments from a shell command while parsing the {expressions}.
+        Return [ (argument, [expressions, ..]), .. ].
+        A pipe between commands is ('', '|'), except in shell mode.
+    '''
+    parse_dollar = not 's' in flags
+    parse_pipe = not 's' in flags
+    parts = []
+    current_part = []
+    current_exprs = []
+    quote = None  # The quote character we are in, if any
+
+    def finish_arg():
+        arg = ''.join(current_part)
+        if arg:
+            parts.append((arg, current_exprs))
+        return [], []
+
+    pos = 0
+    while True:
+        m = re_arg_token.search(s, pos)
+        if not m:
+            current_part.append(s[pos:])
+            break
+        current_part.append(s[pos:m.start()])
+        kind = m.lastgroup
+        token = m.group()
+        pos = m.end()
+
+        if kind == 'quote':
+            if quote is None:
+                quote = token
+            elif quote == token:
+                quote = None
+            current_part.append(token)
+        elif (quote and kind in ('space', 'redirect', 'pipe')
+              or kind == 'pipe' and not parse_pipe):
+            current_part.append(token)  # Not interpreted in quotes
+        elif kind == 'space':  # New argument
+            current_part, current_exprs = finish_arg()
+        elif kind == 'pipe':  # New command
+            current_part, current_exprs = finish_arg()
+            parts.append(('', token))
+        elif kind == 'redirect':
+            current_part, current_exprs = finish_arg()
+            parts.append((s[pos:].strip(), token))
+            return parts  # All the rest is the output expression
+        else:  # An expression in the current argument
+            if kind == 'expr':
+                end = match_py_bracket(s, m.start())
+                token = s[m.start():end]
+                pos = end
+            elif not parse_dollar:
+                current_part.append(token)
+                continue
+            current_part.append('{}')  # for format()
+            if token == '{}':
+                token = '{"{}"}'  # Replace literal {} by itself
+            current_exprs.append(token)
+    finish_arg()
+    return parts
 
 
 re_escape_py = re.compile(r'([\\\'"])')
@@ -267,21 +328,52 @@ def render_sh_arg(arg, exprs):
 
 
 def flags_to_function(flags):
+    if 'b' in flags and ('c' in flags or 'C' in flags):
+        raise SyntaxError('Cannot parse csv from bytes: {}'.format(flags))
+    # The methods of str do not apply to bytes nor to spilled outputs
+    duck = 'b' in flags or 'M' in flags
+
+    if 'L' in flags:  # Lazy, convert each line as it is read
+        if 'j' in flags or 'fl' in flags or 'a' in flags and any(
+                flag in flags for flag in 'cCJt'):
+            raise SyntaxError('Cannot stream with flags {}'.format(flags))
+        if 't' in flags:
+            return 'Table.parse'
+        if 'J' in flags:
+            return 'json_lines'
+        if 'C' in flags:
+            return 'csv_dicts'
+        if 'c' in flags:
+            return 'csv_rows'
+        split = 'splitfields' if duck else 'str.split'
+        for flag, function in (('i', 'int'), ('d', 'float'), ('f', split)):
+            if flag in flags:
+                if 'a' in flags:  # yap_acall converts line by line
+                    return function
+                return 'map_lines({})'.format(function)
+        return 'None'
+
     convert = 'None'
     if 'i' in flags:
         convert = 'int'
     if 'd' in flags:
         convert = 'float'
     if 'j' in flags:
-        convert = 'json.loads'
+        convert = 'loadjson' if 'M' in flags else 'json.loads'
+    if 'c' in flags:
+        convert = 'csv_rows'
+    if 'C' in flags:
+        convert = 'csv_dicts'
+    if 't' in flags:
+        convert = 'Table.parse'
     if 'lf' in flags:
         convert = 'split_lines_fields'
     elif 'fl' in flags:
         convert = 'split_fields_lines'
     elif 'l' in flags:
-        convert = 'str.splitlines'
+        convert = 'splitlines' if duck else 'str.splitlines'
     elif 'f' in flags:
-        convert = 'str.split'
+        convert = 'splitfields' if duck else 'str.split'
     return convert
 
 
@@ -292,8 +384,17 @@ def render_file(raw, mode):
 
 output_flags = ('o', 'e', 'r')
 
-def compile_sh(in_expr, bang, cmd, must_capture):
-    ' Compile a shell command into python code'
+# Name of a program, or its absolute path
+re_program = re.compile(r'[\w.+-]+$|/[\w.+/-]+$')
+
+
+def compile_sh(in_expr, bang, cmd, must_capture, programs=None,
+               in_async=True):
+    """ Compile a shell command into python code. If programs is a list, add
+        to it the names of the programs of the command, when they are known.
+        With --async, the command is awaited if in_async, unless its flags
+        need yap_call.
+    """
     flags = bang[:-1]
 
     # Input as Python expression. Can be a filename, data, or nothing
@@ -304,7 +405,7 @@ def compile_sh(in_expr, bang, cmd, must_capture):
         infile = in_expr or 'None'
 
     # The command, arguments list and output file
-    parts = parse_cmd(cmd.strip(), flags)
+    parts = parse_cmd(cmd, flags)
     if parts and parts[-1][1] == '>':
         argparts = parts[:-1]
         # Prepare the output file which is a Python expression
@@ -316,19 +417,56 @@ def compile_sh(in_expr, bang, cmd, must_capture):
 
     if must_capture and not any(f in flags for f in output_flags):
         flags += 'o'  # By default, capture stdout if inside an expression
-
-    # Render the expressions in arguments
-    cmd_args = [render_sh_arg(arg, exprs) for arg, exprs in argparts]
-    if dry_run:
-        cmd_args.insert(0, '"echo"')
+    if 'J' in flags and 'L' not in flags:
+        flags += 'L'  # Documents as they come
+    if 'L' in flags and not ('o' in flags or 'O' in flags):
+        flags += 'o'  # Lines of stdout
+    if 'a' in flags and any(flag in flags for flag in 'Mk'):
+        raise SyntaxError('Cannot run asynchronously with flags {}'.format(
+            flags))
+    # Not the commands that give a process, a job or lines to iterate on
+    awaited = (async_calls and in_async and 'a' not in flags and
+               not any(flag in flags for flag in 'pLMk'))
+    if awaited:
+        flags += 'a'
+
+    # Render the expressions in arguments, for each command of a pipeline
+    pipeline = [[]]
+    names = []  # Of the programs, when literal
+    for arg, exprs in argparts:
+        if exprs == '|':
+            pipeline.append([])
+        else:
+            if not pipeline[-1] and not exprs and re_program.match(arg):
+                names.append(arg)
+            pipeline[-1].append(render_sh_arg(arg, exprs))
+    if len(pipeline) > 1 and not all(pipeline):
+        raise SyntaxError('Empty command in pipeline: {}'.format(cmd.strip()))
+    if programs is not None and not (dry_run or 's' in flags or 'k' in flags):
+        programs.extend(names)  # Of programs, not of shell builtins
+    if dry_run:  # Echo the whole pipeline
+        cmd_args = ['"echo"'] + pipeline[0]
+        for cmd_args_next in pipeline[1:]:
+            cmd_args += ['"|"'] + cmd_args_next
+        pipeline = [cmd_args]
+
+    if len(pipeline) == 1:
+        cmd_list = '[{}]'.format(', '.join(pipeline[0]))
+    else:  # List of commands
+        cmd_list = '[{}]'.format(', '.join(
+            '[{}]'.format(', '.join(cmd_args)) for cmd_args in pipeline))
 
     # Output conversions
     convert = flags_to_function(flags)
 
     # Call the process
-    process = 'yap_call([{}], "{}", ({}), {}, {})'.format(
-        ', '.join(cmd_args), flags, infile, convert, outfile)
-    return process
+    if 'a' in flags:  # A coroutine, awaited in async mode
+        template = 'yap_acall({}, "{}", ({}), {}, {})'
+        if awaited:
+            template = '(await {})'.format(template)
+    else:
+        template = 'yap_call({}, "{}", ({}), {}, {})'
+    return template.format(cmd_list, flags, infile, convert, outfile)
 
 
 # Find environment variables
@@ -355,35 +493,419 @@ def expand_env_soft(py):
                 r'sys.argv[1:]', py)))
 
 
-def expand_python(s):
-    ' Expand shell commands in python code. '
+re_par_for = re.compile(r'''
+    (?P<indent> [ \t]* ) par (?: \( (?P<max_jobs> [^)]* ) \) )? [ \t]+
+    for [ \t]+ (?P<target> .+? ) [ \t]+ in [ \t]+ (?P<items> .+? )
+    : [ \t]* (?: \#.* )? $
+''', re.X)
+
+re_par_target = re.compile(r'''
+    \(? [ \t]*
+    (?P<names> \w+ (?: [ \t]* , [ \t]* \w+ )* [ \t]* ,? )
+    [ \t]* \)? $
+''', re.X)
+
+
+def expand_par_for(s, source_map=None):
+    ''' Compile `par for x in items:` loops into a function of x, and a call
+        of par_for() after the loop body. `par(n) for` runs at most n at once.
+        The call takes the place of an empty line after the body, if any, so
+        the next lines keep their numbers. If source_map is a list, add to it
+        the line of s of each line of the result, counting from 1.
+    '''
+    if 'par' not in s:
+        if source_map is not None:
+            source_map.extend(range(1, s.count('\n') + 2))
+        return s
+    out = []
+    lines = []  # Line of s of each line of out
+    pending = []  # Loops whose body is not finished: (indent, call, line)
+
+    def close_loop():
+        _, call, line = pending.pop()
+        if out and out[-1].isspace():
+            out[-1] = call
+            lines[-1] = line
+        else:
+            out.append(call)
+            lines.append(line)
+
+    in_strings = string_lines(s)
+    count = 0
+    for number, line in enumerate(s.splitlines(True), 1):
+        if number in in_strings:  # Not code, as is
+            lines.append(number)
+            out.append(line)
+            continue
+        code = line.strip()
+        if code and not code.startswith('#'):
+            indent = len(line) - len(line.lstrip())
+            while pending and indent <= pending[-1][0]:
+                close_loop()
+        lines.append(number)
+        m = re_par_for.match(line)
+        if not m:
+            out.append(line)
+            continue
+        target = re_par_target.match(m.group('target'))
+        if not target:
+            raise SyntaxError(
+                'par for: unsupported loop variables: ' + m.group('target'))
+        names = target.group('names').rstrip(', \t')
+        star = ',' in target.group('names')
+        count += 1
+        function = '_yap_par_for_{}'.format(count)
+        indent = m.group('indent')
+        out.append('{}def {}({}):\n'.format(indent, function, names))
+        call = '{}par_for({}, {}'.format(indent, function, m.group('items'))
+        if m.group('max_jobs'):
+            call += ', max_jobs={}'.format(m.group('max_jobs'))
+        if star:
+            call += ', star=True'
+        pending.append((len(indent), call + ')\n', number))
+    if pending and not out[-1].endswith('\n'):
+        out[-1] += '\n'
+    while pending:
+        close_loop()
+    if source_map is not None:
+        source_map.extend(lines)
+        if out[-1].endswith('\n'):  # The empty last line
+            source_map.append(s.count('\n') + 1)
+    return ''.join(out)
+
+
+re_scope = re.compile(r'[ \t]*(?P<async> async[ \t]+ )?(?P<kind> def|class )\b',
+                      re.X)
+
+
+def sync_lines(s):
+    ''' Return the numbers of the lines of s in a function that is not async,
+        or in a class, where await is not allowed. Like for par for, blocks
+        are found by their indentation.
+    '''
+    in_strings = string_lines(s)
+    numbers = set()
+    scopes = []  # Enclosing functions and classes: (indent, async)
+    for number, line in enumerate(s.splitlines(True), 1):
+        code = line.strip()
+        if number not in in_strings and code and not code.startswith('#'):
+            indent = len(line) - len(line.lstrip())
+            while scopes and indent <= scopes[-1][0]:
+                scopes.pop()
+            m = re_scope.match(line)
+            if m:
+                scopes.append(
+                    (indent, bool(m.group('async')) and m.group('kind') == 'def'))
+        if scopes and not scopes[-1][1]:
+            numbers.add(number)
+    return numbers
+
+
+def expand_python(s, source_map=None, programs=None):
+    ''' Expand shell commands in python code. Commands keep the lines they
+        span. If source_map is a list, add to it the line of s of each line
+        of the result, counting from 1. If programs is a list, add to it the
+        programs of the commands, see compile_sh(). With --async,
+        commands in functions that are not async are not awaited.
+    '''
+    base = len(source_map) if source_map is not None else 0
+    s = expand_par_for(s, source_map)
     parts = split_bang(s)
+    sync = sync_lines(s) if async_calls else set()
+    line = [1]  # Of the next part
+    start = [0]  # Position of the next part in s
 
     def do_inline_sh(py, in_expr, bang, cmd):
+        bang_start = start[0] + len(py) + len(in_expr or '')
+        cmd_start = bang_start + len(bang or '')
+        start[0] = cmd_start + len(cmd or '')
         expanded_py = expand_env_soft(py)
+        number = line[0] + py.count('\n')
         if not cmd:
+            line[0] = number
             return expanded_py
+        number += in_expr.count('\n')
+        line[0] = number + cmd.count('\n')
         pystrip = py.strip()
         mixed = pystrip and pystrip != '('  # Shell inside of a Python expression
+        breaks = in_expr.count('\n') + cmd.count('\n')
         in_expr = in_expr.strip() or 'None'
-        return '{}{}'.format(expanded_py, gray(
-            compile_sh(in_expr, bang, cmd, must_capture=mixed)))
-
-    return ''.join(starmap(do_inline_sh, parts))
+        try:
+            call = compile_sh(in_expr, bang, cmd, mixed, programs,
+                              number not in sync)
+        except SyntaxError as e:  # Point to the command, or into it
+            pos = bang_start
+            if e.lineno:
+                pos = cmd_start
+                for _ in range(e.lineno - 1):
+                    pos = cmd.index('\n', pos - cmd_start) + cmd_start + 1
+                pos += e.offset - 1
+            raise syntax_error(e.msg, s, pos) from None
+        missing = breaks - call.count('\n')
+        if missing > 0:  # Line breaks inside of the call
+            call = call[:-1] + '\n' * missing + call[-1]
+        return '{}{}'.format(expanded_py, gray(call))
+
+    try:
+        return ''.join(starmap(do_inline_sh, parts))
+    except SyntaxError as e:  # To the line of the source, before par for
+        if e.lineno and source_map is not None:
+            e.lineno = source_map[base + e.lineno - 1]
+        raise
 
 
 # A convenience function around Popen, configured by letters flags.
 # Allows to perform several operations as a single expression (function call).
 call_lib = r'''
 from subprocess import Popen, PIPE, STDOUT, CalledProcessError
-import re
+from functools import lru_cache
 
 re_escape_sh = re.compile(r'([\\ ])')
 
 def escape_sh(s):
     return re_escape_sh.sub(r'\\\1', s)
 
-def yap_call(cmd, flags='', infile=None, convert=None, outfile=None):
+def spawn_process(cmd, posix_spawn=False, **kwargs):
+    """ Start cmd with Popen, giving it the path of the program, searched
+        once per PATH. With posix_spawn, the child does not copy the memory
+        of the interpreter: given no file descriptors to close, Popen uses
+        os.posix_spawn(). It still forks when that cannot be done: for a
+        program not found, or a redirection given as file descriptor 0, 1
+        or 2. Inherited standard files work.
+    """
+    if not kwargs.get('shell'):
+        env = kwargs.get('env')
+        path = (os.environ if env is None else env).get('PATH', os.defpath)
+        kwargs['executable'] = find_program(cmd[0], path)
+    if posix_spawn:
+        kwargs['close_fds'] = False  # Python does not let children inherit
+    return Popen(cmd, **kwargs)
+
+@lru_cache(maxsize=1024)
+def find_program(name, path):
+    ' Path of the program name, searched in the directories of path, or None '
+    import shutil
+    return shutil.which(name, path=path)
+
+def yap_require(names):
+    """ Find the programs that the script may run, before it starts, and exit
+        with the list of the missing ones. Added by yap --check.
+    """
+    path = os.environ.get('PATH', os.defpath)
+    missing = [name for name in names if not find_program(name, path)]
+    if missing:
+        sys.exit('Programs not found: {}'.format(', '.join(missing)))
+
+class Pipeline(object):
+    """ Commands connected by pipes, each output to the next input.
+        Used like a single Popen. The return code is the one of the last
+        command that failed, like with pipefail. Like in a shell, stderr
+        STDOUT only merges the errors of the last command, the others
+        write theirs to the console.
+    """
+    def __init__(self, cmds, stdin=None, stdout=None, stderr=None, **kwargs):
+        self.cmds = cmds
+        self.procs = []
+        try:
+            for i, cmd in enumerate(cmds):
+                last = i == len(cmds) - 1
+                proc = spawn_process(
+                    cmd,
+                    stdin=self.procs[-1].stdout if self.procs else stdin,
+                    stdout=stdout if last else PIPE,
+                    stderr=None if stderr == STDOUT and not last else stderr,
+                    **kwargs)
+                if self.procs:  # Now only read by the next command
+                    self.procs[-1].stdout.close()
+                self.procs.append(proc)
+        except BaseException:
+            for proc in self.procs:
+                proc.kill()
+                proc.wait()
+            raise
+        self.stdin = self.procs[0].stdin
+        self.stdout = self.procs[-1].stdout
+        self.stderr = self.procs[-1].stderr
+        self.pid = self.procs[-1].pid
+
+    @property
+    def returncode(self):
+        codes = [proc.returncode for proc in self.procs]
+        if None in codes:
+            return None
+        return ([code for code in codes if code] or [0])[-1]
+
+    @property
+    def failed(self):
+        ' The last command that failed '
+        for cmd, proc in reversed(list(zip(self.cmds, self.procs))):
+            if proc.returncode:
+                return cmd
+
+    def poll(self):
+        for proc in self.procs:
+            proc.poll()
+        return self.returncode
+
+    def wait(self):
+        for proc in self.procs:
+            proc.wait()
+        return self.returncode
+
+    def terminate(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.terminate()
+
+    def communicate(self, input=None):
+        ' Like Popen.communicate(), with the errors of all commands '
+        threads, errs = drain_stderr(self.procs[:-1])
+        if self.stdin:
+            threads.append(feed_input(self.stdin, input))
+        out, err = self.procs[-1].communicate()
+        for thread in threads:
+            thread.join()
+        self.wait()
+        return out, join_outputs(errs + [err])
+
+def drain_stderr(procs):
+    """ Read the errors of the processes from threads, so that none blocks
+        on a full pipe. Return the threads, and the list of errors they fill.
+    """
+    errs = [None] * len(procs)
+
+    def drain(i, f):
+        errs[i] = f.read()
+        f.close()
+
+    threads = [
+        threading.Thread(target=drain, args=(i, proc.stderr))
+        for i, proc in enumerate(procs) if proc.stderr]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads, errs
+
+def join_outputs(outputs):
+    outputs = [output for output in outputs if output is not None]
+    return outputs[0][:0].join(outputs) if outputs else None
+
+def feed_input(f, data):
+    """ Write data to f from a thread, and close it. Data is a string, or
+        any iterable of strings or bytes, consumed as the command reads it.
+        Return the thread. An error of the iterable is kept in its .error.
+    """
+    text = hasattr(f, 'encoding')
+
+    def write(chunk):
+        if isinstance(chunk, bytes) and text:
+            f.flush()
+            f.buffer.write(chunk)
+        elif not isinstance(chunk, bytes) and not text:
+            f.write(chunk.encode(yapconfig.encoding or 'utf-8'))
+        else:
+            f.write(chunk)
+
+    def feed():
+        try:
+            if isinstance(data, (str, bytes)):
+                write(data)
+            elif data is not None:
+                for chunk in data:
+                    write(chunk)
+        except (IOError, OSError):
+            pass  # The command does not read it all
+        except Exception as e:
+            thread.error = e
+        finally:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    thread = threading.Thread(target=feed)
+    thread.daemon = True
+    thread.error = None
+    thread.start()
+    return thread
+
+def check_input(feeder):
+    ' Raise the error of the input iterable, if any '
+    if feeder:
+        feeder.join()
+        if feeder.error:
+            raise feeder.error
+
+def failure(proc, cmd, output=None):
+    if isinstance(proc, Pipeline):
+        cmd = proc.failed
+    return CalledProcessError(proc.returncode, cmd, output)
+
+def stream_lines(proc, cmd, flags, feeder=None, call=None):
+    """ Yield the lines of the output as the process writes them, then check
+        the return code. Closing the iterator early stops the process.
+        The hooks of call, if any, run when it ended.
+    """
+    newline = b'\n' if 'b' in flags else '\n'
+    keep_ends = 'c' in flags or 'C' in flags  # For csv fields on many lines
+    try:
+        for line in proc.stdout:
+            yield line if keep_ends else line.rstrip(newline)
+    except GeneratorExit:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+        if call:
+            call.exited(proc.returncode)
+        raise
+    proc.stdout.close()
+    try:
+        check_input(feeder)
+        proc.wait()
+        if call:
+            call.exited(proc.returncode)
+        if proc.returncode != 0 and 'n' not in flags:
+            raise failure(proc, cmd)
+    except Exception as exception:
+        if call:
+            call.failed(exception)
+        raise
+
+job_groups = []  # Jobs blocks, p! commands run in the last one
+coshells = []  # Coshell blocks, k! commands run in the last one
+
+def yap_call(cmd, flags='', infile=None, convert=None, outfile=None,
+             site=None):
+    if yaphooks:  # Instrumented, site is the caller
+        return hooked_call(
+            cmd, flags, infile, convert, outfile, site or call_site())
+    if 'p' in flags and job_groups:  # A job of the current group
+        return job_groups[-1].submit(
+            yap_call, cmd, flags.replace('p', ''), infile, convert, outfile)
+    return run_call(cmd, flags, infile, convert, outfile)
+
+def hooked_call(cmd, flags, infile, convert, outfile, site):
+    ' yap_call running the functions of yaphooks '
+    if 'p' in flags and job_groups:
+        return job_groups[-1].submit(
+            yap_call, cmd, flags.replace('p', ''), infile, convert, outfile,
+            site)
+    call = Call(cmd, flags, infile, site)
+    try:
+        return run_call(cmd, flags, infile, convert, outfile, call)
+    except Exception as exception:
+        call.failed(exception)
+        raise
+
+def run_call(cmd, flags, infile, convert, outfile, call=None):
+    if ('k' in flags and infile is None and outfile is None and
+            not any(flag in flags for flag in 'pLMbeOv')):
+        return coshell_call(cmd, flags, convert, call)
+    if cmd and isinstance(cmd[0], list):  # Pipeline of commands
+        spawn = Pipeline
+    else:
+        spawn = spawn_process
     if 's' in flags:  # Shell mode
         cmd = ' '.join(map(escape_sh, cmd))
     if infile is None or hasattr(infile, 'fileno'):
@@ -394,26 +916,60 @@ def yap_call(cmd, flags='', infile=None, convert=None, outfile=None):
         indata = infile
     outfd = outfile or PIPE
 
-    proc = Popen(
+    if call:
+        call.spawning()
+    proc = spawn(
         cmd,
         stdin=infd,
         stdout=outfd if ('o' in flags or 'O' in flags) else None,
         stderr=(
-            outfd if 'e' in flags else
+            outfd if 'e' in flags and 'L' not in flags else
             STDOUT if 'O' in flags else None),
         universal_newlines='b' not in flags,
+        encoding=None if 'b' in flags else yapconfig.encoding,
+        errors=None if 'b' in flags else yapconfig.errors,
         shell='s' in flags,
         env={} if 'v' in flags else None,
         bufsize=-1,  # Buffered
+        posix_spawn='x' in flags or yapconfig.spawn == 'posix_spawn',
     )
+    if call:
+        call.spawned(proc)
+    feeder = None
+    streaming = 'L' in flags and proc.stdout
+    data_type = bytes if 'b' in flags else str
+    if indata is not None and (
+            streaming or not isinstance(indata, data_type)):
+        # Write the input while the output is read, converting its type
+        stdin, proc.stdin = proc.stdin, None
+        feeder = feed_input(stdin, indata)
+        indata = None
+
     if 'p' in flags:  # Run in the background
+        if call:  # Its exit hooks run when it ends
+            call.background()
         return proc
+    if streaming:  # Iterate on lines as they come
+        lines = stream_lines(proc, cmd, flags, feeder, call)
+        return convert(lines) if convert else lines
 
-    out, err = proc.communicate(indata)
+    if 'M' in flags and proc.stdout:  # Big output, spill it to disk
+        out, err = communicate_spilled(proc, indata)
+    else:
+        out, err = proc.communicate(indata)
     if outfile:
         outfile.close()
-
-    code = proc.returncode
+    if call:
+        call.exited(proc.returncode, out, err)
+    check_input(feeder)
+    return call_result(
+        flags, convert, out, err, proc.returncode,
+        lambda ret: failure(proc, cmd, ret))
+
+def call_result(flags, convert, out, err, code, failure):
+    """ Return the outputs selected by the flags: either the unique one, the
+        list of them, or None. Raise failure(outputs) if the command failed.
+    """
     ret = []
     if ('o' in flags or 'O' in flags):
         if convert:
@@ -426,24 +982,55 @@ def yap_call(cmd, flags='', infile=None, convert=None, outfile=None):
         ret.append(code)
     else:  # The user won't check the return code, so do it now
         if code != 0 and 'n' not in flags:
-            raise CalledProcessError(code, cmd, ret)
-    # Return either the unique output, the list of outputs, or None
+            raise failure(ret)
     return ret[0] if len(ret) == 1 else ret or None
 '''
 
 convert_lib = r'''
-import json
 try:
     from itertools import zip_longest
 except ImportError:
     from itertools import izip_longest as zip_longest
+from functools import lru_cache
 
 def split_lines_fields(s):
-    return list(map(str.split, s.splitlines()))
+    return [line.split() for line in s.splitlines()]
 
 def split_fields_lines(s):
     return list(zip_longest(*split_lines_fields(s)))
 
+def map_lines(function):
+    ' Convert each line of a stream '
+    return lambda lines: map(function, lines)
+
+def json_lines(lines):
+    """ Decode one JSON document per line, lazily, skipping blank lines.
+        An invalid line raises ValueError with its number.
+    """
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError(
+                    'Invalid JSON on line {}, column {}: {}'.format(
+                        number, e.colno, e.msg))
+
+def splitlines(output):
+    ' The lines of a str, bytes or spilled output '
+    return output.splitlines()
+
+def splitfields(output):
+    ' The fields separated by white space of a str, bytes or spilled output '
+    return output.split()
+
+def loadjson(output):
+    ' Decode a str, bytes or spilled output '
+    if hasattr(output, 'open'):
+        with output.open() as f:
+            return json.load(f)
+    return json.loads(output)
+
 def concat(strings):
     return ''.join(strings)
 
@@ -464,11 +1051,1377 @@ def write(filename, content):
     with open(filename, 'w') as fd:
         fd.write(content)
 
+grep_block_size = 2**20
+
 def grep(regex, lines):
+    """ Filter the lines matching regex. Lines are a string, a path, an open
+        file, or any iterable of lines. Files are searched by large blocks,
+        memory-mapped if binary: only the matching lines are split out.
+    """
+    line_re, block_re = grep_regexes(regex)
+    if isinstance(lines, (str, bytes)):
+        return filter(line_re.search, lines.splitlines())
+    if hasattr(lines, 'mmap'):  # Spilled output of M!, search its file
+        return grep_path(line_re, block_re, lines.name)
+    if hasattr(lines, 'read') and block_re:
+        return grep_file(line_re, block_re, lines)
+    if isinstance(lines, os.PathLike):
+        return grep_path(line_re, block_re, lines)
+    return filter(line_re.search, lines)
+
+@lru_cache(maxsize=64)
+def grep_regexes(regex):
+    """ The regex for one line, and the one finding candidates in a block,
+        or None if it anchors to the start or end of the string.
+    """
+    line_re = re.compile(regex)
+    pattern = line_re.pattern
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('latin-1')
+    if '\\A' in pattern or '\\Z' in pattern:
+        return line_re, None
+    return line_re, re.compile(line_re.pattern, line_re.flags | re.M)
+
+def grep_path(line_re, block_re, path):
+    binary = isinstance(line_re.pattern, bytes)
+    with open(path, 'rb' if binary else 'r') as f:
+        lines = grep_file(line_re, block_re, f) if block_re else filter(
+            line_re.search, f)
+        for line in lines:
+            yield line
+
+def grep_file(line_re, block_re, f):
+    ' Yield the matching lines of a file, from its current position '
+    binary = not hasattr(f, 'encoding')
+    newline = b'\n' if binary else '\n'
+    if binary and hasattr(f, 'fileno'):
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, io.UnsupportedOperation):
+            pass  # Empty, or not a regular file
+        else:
+            with buf:
+                for _, line in grep_block(
+                        line_re, block_re, buf, newline, f.tell()):
+                    yield line
+            f.seek(0, io.SEEK_END)
+            return
+    while True:
+        block = f.read(grep_block_size)
+        if not block:
+            return
+        block += f.readline()  # End on a line boundary
+        for _, line in grep_block(line_re, block_re, block, newline):
+            yield line
+
+def grep_block(line_re, block_re, block, newline, pos=0):
+    """ Yield (position, line) for the lines of block that line_re matches.
+        Search candidates with block_re, then check their line alone, as a
+        match can span lines.
+    """
+    while pos < len(block):
+        m = block_re.search(block, pos)
+        if not m:
+            return
+        start = block.rfind(newline, 0, m.start()) + 1
+        if start == len(block):  # Empty match after the last line
+            return
+        end = block.find(newline, m.start())
+        end = len(block) if end < 0 else end + 1
+        line = block[start:end]
+        if line_re.search(line):
+            yield start, line
+        pos = end
+
+grep_chunk_size = 2**24
+
+def grep_files(regex, paths, workers=None):
+    """ Search files in parallel processes, by default one per CPU. Big files
+        are split in chunks at line boundaries. Yield (path, line number,
+        line without newline) in the order of the files and lines.
+    """
+    line_re, block_re = grep_regexes(regex)
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        chunks.extend(
+            (line_re, block_re, path, start, start + grep_chunk_size)
+            for start in range(0, size or 1, grep_chunk_size))
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1 and hasattr(os, 'fork'):
+        results = fork_map(grep_chunk, chunks, workers)
+    else:
+        results = (grep_chunk(*chunk) for chunk in chunks)
+    for (_, _, path, start, _), (count, matches) in zip(chunks, results):
+        if start == 0:
+            lines_before = 0
+        for index, line in matches:
+            yield path, lines_before + index + 1, line
+        lines_before += count
+
+def grep_chunk(line_re, block_re, path, start, end):
+    """ Search the lines starting between start and end in the file. Return
+        their count, and the matches as [(line index, line), ..].
+    """
+    with open(path, 'rb') as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()  # The end of a line of the previous chunk
+        data = f.read(max(end - f.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    newline = b'\n'
+    if not isinstance(line_re.pattern, bytes):
+        from locale import getpreferredencoding
+        data = data.decode(getpreferredencoding(False))
+        newline = '\n'
+    if not block_re:  # Check every line
+        block_re = re.compile(newline[:0] + '^', re.M)
+    matches = []
+    index = last = 0
+    for pos, line in grep_block(line_re, block_re, data, newline):
+        index += data.count(newline, last, pos)
+        last = pos
+        matches.append((index, line.rstrip(newline)))
+    return data.count(newline), matches
+
+def fork_map(function, items, workers):
+    """ Yield function(*item) for each item, computed in forked processes.
+        The worker i does the items i, i + workers, .. and sends the results
+        in order through its pipe. Closing the iterator stops the workers.
+    """
+    import pickle
+    import signal
+    import struct
+    procs = []
+    try:
+        for i in range(workers):
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:  # Worker
+                code = 0
+                try:
+                    os.close(read_end)
+                    for _, pipe in procs:  # Of other workers
+                        pipe.close()
+                    with os.fdopen(write_end, 'wb') as pipe:
+                        for item in items[i::workers]:
+                            try:
+                                result = True, function(*item)
+                            except Exception as e:
+                                result = False, e
+                            data = pickle.dumps(result, -1)
+                            pipe.write(struct.pack('<Q', len(data)) + data)
+                except BaseException:
+                    code = 1
+                finally:
+                    os._exit(code)
+            os.close(write_end)
+            procs.append((pid, os.fdopen(read_end, 'rb')))
+
+        for i in range(len(items)):
+            pipe = procs[i % workers][1]
+            header = pipe.read(8)
+            if len(header) < 8:
+                raise ChildProcessError('A worker process died')
+            ok, result = pickle.loads(
+                pipe.read(struct.unpack('<Q', header)[0]))
+            if not ok:
+                raise result
+            yield result
+    finally:
+        for pid, pipe in procs:
+            pipe.close()
+            try:
+                os.kill(pid, signal.SIGKILL)  # If not done yet
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+'''
+
+
+jobs_lib = r'''
+from threading import Thread, Semaphore
+
+class Job(Thread):
+    ' A function running in parallel, in a group of Jobs '
+    def __init__(self, slots, function, args, kwargs):
+        Thread.__init__(self)
+        self.daemon = True
+        self.slots = slots
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.value = self.error = None
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except BaseException as e:  # Even sys.exit(), to not lose it
+            self.error = e
+        finally:
+            self.slots.release()
+
+    def result(self):
+        ' Wait for the job, return its value or raise its error '
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class JobsError(Exception):
+    ' Some jobs failed, their exceptions are in .errors '
+    def __init__(self, errors):
+        Exception.__init__(self, '{} job(s) failed: {}'.format(
+            len(errors), '; '.join(map(str, errors[:3]))))
+        self.errors = errors
+
+class Jobs(object):
+    """ A group of jobs running in parallel, at most max_jobs at a time,
+        by default one per CPU. In a `with Jobs():` block, p! commands are
+        jobs of the group. Leaving the block waits for all of them.
+    """
+    def __init__(self, max_jobs=None):
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.slots = Semaphore(self.max_jobs)
+        self.jobs = []
+        self.results = None
+
+    def submit(self, function, *args, **kwargs):
+        ' Start function(*args, **kwargs) when a slot is free. Return a Job '
+        self.slots.acquire()
+        job = Job(self.slots, function, args, kwargs)
+        self.jobs.append(job)
+        job.start()
+        return job
+
+    def map(self, function, items):
+        for item in items:
+            self.submit(function, item)
+        return self.wait()
+
+    def wait(self):
+        """ Wait for all the jobs. Return their results in order, or raise
+            JobsError with all the errors.
+        """
+        for job in self.jobs:
+            job.join()
+        errors = [job.error for job in self.jobs if job.error]
+        if errors:
+            raise JobsError(errors)
+        self.results = [job.value for job in self.jobs]
+        return self.results
+
+    def __enter__(self):
+        job_groups.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        job_groups.remove(self)
+        if exc_type is None:
+            self.wait()
+        else:  # Do not hide the exception
+            for job in self.jobs:
+                job.join()
+
+def par_for(function, items, max_jobs=None, star=False):
+    """ Call function on the items in parallel, the body of a `par for` loop.
+        Return the results in order. After a failure, no more items are
+        started, and the first one that failed raises its error.
+    """
+    jobs = Jobs(max_jobs)
+    failed = []
+
+    def run(item):
+        if failed:  # Failed while this item waited for a slot
+            return None
+        try:
+            return function(*item) if star else function(item)
+        except BaseException:
+            failed.append(item)
+            raise
+
+    for item in items:
+        if failed:
+            break
+        jobs.submit(run, item)
+    for job in jobs.jobs:
+        job.result()
+    return [job.value for job in jobs.jobs]
+'''
+
+
+coproc_lib = r'''
+class Coprocess(object):
+    """ A process kept running, that answers each line it reads by a line,
+        like bc. It starts on the first request, and stops with close():
+            with Coprocess(['bc', '-l']) as bc:
+                third = float(bc.ask('1 / 3'))
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.lock = threading.Lock()  # One request at a time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        self.proc = Popen(
+            self.cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True,
+            encoding=yapconfig.encoding, errors=yapconfig.errors)
+
+    def send(self, text):
+        ' Write the text of a request, starting the process if needed '
+        if self.proc is None:
+            self.start()
+        self.proc.stdin.write(text)
+        self.proc.stdin.flush()
+
+    def receive(self):
+        ' Read a line of response, without its end. Raise if it stopped '
+        line = self.proc.stdout.readline()
+        if not line:  # Exited, the next request starts it again
+            proc, self.proc = self.proc, None
+            proc.stdin.close()
+            raise CalledProcessError(proc.wait(), self.cmd)
+        return line[:-1] if line.endswith('\n') else line
+
+    def ask(self, line):
+        ' Send a line, return the line answering it '
+        with self.lock:
+            self.send(line + '\n')
+            return self.receive()
+
+    def close(self):
+        ' Stop the process, at the end of its input, and wait for it '
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+class Coshell(Coprocess):
+    """ A shell kept running to run commands, that do not start one each
+        time. In a `with Coshell():` block, k! commands run in it, otherwise
+        in a shell shared by the script. Its commands have the directory and
+        environment of the shell, no input, and the errors of the script.
+        One that exits stops the shell, which the next command starts again.
+    """
+    def __init__(self, shell='/bin/sh'):
+        Coprocess.__init__(self, [shell])
+        self.marker = 'yap-{}'.format(os.urandom(8).hex())
+
+    def __enter__(self):
+        coshells.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        coshells.remove(self)
+        self.close()
+
+    def run(self, line):
+        ' Run the command line, return its output and exit code '
+        end = self.marker + ' '
+        with self.lock:
+            # A new line then the marker with the code follow the output
+            self.send('{{ {}\n}} </dev/null\nprintf "\\n{}%d\\n" $?\n'.format(
+                line, end))
+            lines = []
+            while True:
+                reply = self.receive()
+                if reply.startswith(end):
+                    return '\n'.join(lines), int(reply[len(end):])
+                lines.append(reply)
+
+def shell_line(cmd):
+    ' The shell command line running cmd, a command or a pipeline of them '
+    import shlex
+    if cmd and isinstance(cmd[0], list):
+        return ' | '.join(map(shell_line, cmd))
+    return ' '.join(map(shlex.quote, cmd))
+
+def coshell_call(cmd, flags, convert, call=None):
+    ' Run cmd with the flags in the current Coshell, like run_call() '
+    if not coshells:  # Shared by the script, until it exits
+        coshells.append(Coshell())
+    if 's' in flags:
+        line = ' '.join(map(escape_sh, cmd))
+    else:
+        line = shell_line(cmd)
+    if call:
+        call.spawning()
+    out, code = coshells[-1].run(line)
+    if call:
+        call.exited(code, out)
+    if 'o' not in flags:  # Like printed by the command
+        sys.stdout.write(out)
+    return call_result(
+        flags, convert, out, None, code,
+        lambda ret: CalledProcessError(code, cmd, ret))
+'''
+
+
+async_lib = r'''
+def yap_acall(cmd, flags='', infile=None, convert=None, outfile=None,
+              site=None):
+    """ Like yap_call, as a coroutine: the commands run on the asyncio event
+        loop instead of blocking. With L, return an async iterator of lines,
+        converted one by one. With p, return the (last) process, that cannot
+        be a job of Jobs. The flags M and k are not supported.
+    """
+    if 'p' in flags and job_groups:
+        raise ValueError('ap! commands cannot be jobs, use p! in Jobs')
+    if yaphooks:  # Instrumented, site is the caller
+        return hooked_acall(
+            cmd, flags, infile, convert, outfile, site or call_site())
+    return run_acall(cmd, flags, infile, convert, outfile)
+
+async def hooked_acall(cmd, flags, infile, convert, outfile, site):
+    ' yap_acall running the functions of yaphooks '
+    call = Call(cmd, flags, infile, site)
+    try:
+        return await run_acall(cmd, flags, infile, convert, outfile, call)
+    except Exception as exception:
+        call.failed(exception)
+        raise
+
+async def run_acall(cmd, flags, infile, convert, outfile, call=None):
+    import asyncio
+    kwargs = {'env': {} if 'v' in flags else None}
+    if 's' in flags:  # Shell mode
+        cmds = [' '.join(map(escape_sh, cmd))]
+        spawn = asyncio.create_subprocess_shell
+    else:
+        cmds = cmd if cmd and isinstance(cmd[0], list) else [cmd]
+        path = (kwargs['env'] or os.environ).get('PATH', os.defpath)
+        if 'x' in flags or yapconfig.spawn == 'posix_spawn':
+            kwargs['close_fds'] = False  # Like spawn_process()
+        spawn = lambda args, **kwargs: asyncio.create_subprocess_exec(
+            *args, executable=find_program(args[0], path), **kwargs)
+    if infile is None or hasattr(infile, 'fileno'):
+        stdin = infile
+        indata = None
+    else:
+        stdin = PIPE
+        indata = infile
+    outfd = outfile or PIPE
+    stdout = outfd if ('o' in flags or 'O' in flags) else None
+    stderr = (
+        outfd if 'e' in flags and 'L' not in flags else
+        STDOUT if 'O' in flags else None)
+
+    if call:
+        call.spawning()
+    procs = []
+    try:
+        for i, args in enumerate(cmds):
+            last = i == len(cmds) - 1
+            read_end, write_end = (None, stdout) if last else os.pipe()
+            try:
+                procs.append(await spawn(
+                    args, stdin=stdin, stdout=write_end,
+                    stderr=None if stderr == STDOUT and not last else stderr,
+                    **kwargs))
+            except BaseException:
+                if read_end is not None:
+                    os.close(read_end)
+                raise
+            finally:  # Pipe ends now used by the commands only
+                if i:
+                    os.close(stdin)
+                if not last:
+                    os.close(write_end)
+            stdin = read_end
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            await proc.wait()
+        raise
+    if call:
+        call.spawned(AsyncPipeline(procs, cmds))
+
+    feeder = None
+    if indata is not None:
+        feeder = asyncio.ensure_future(feed_ainput(procs[0].stdin, indata))
+    if 'p' in flags:
+        if call:  # Its exit hooks run when it ends
+            call.background(thread=False)
+            asyncio.ensure_future(wait_background(procs, cmds, call))
+        return procs[-1]
+    if 'L' in flags and procs[-1].stdout:
+        return stream_alines(procs, cmds, flags, convert, feeder, call)
+
+    readers = [procs[-1].stdout] + [proc.stderr for proc in procs]
+    outputs = await asyncio.gather(*[
+        reader.read() if reader else asyncio.sleep(0) for reader in readers])
+    if 'b' not in flags:
+        outputs = [decode_output(data) for data in outputs]
+    out = outputs[0]
+    err = join_outputs(outputs[1:])
+    for proc in procs:
+        await proc.wait()
+    if outfile:
+        outfile.close()
+    code, failed = areturncode(procs, cmds)
+    if call:
+        call.exited(code, out, err)
+    input_error = feeder and await feeder
+    if input_error:
+        raise input_error
+    return call_result(
+        flags, convert, out, err, code,
+        lambda ret: CalledProcessError(code, failed, ret))
+
+async def wait_background(procs, cmds, call):
+    ' Run the exit hooks of an ap! command once it ended '
+    for proc in procs:
+        await proc.wait()
+    call.exited_background(areturncode(procs, cmds)[0])
+
+class AsyncProcess(object):
+    ' A process of yap_acall for yaphooks, like a Popen that poll() reads '
+    def __init__(self, process, args):
+        self.process = process
+        self.args = args
+        self.pid = process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def poll(self):
+        return self.process.returncode
+
+class AsyncPipeline(object):
+    ' The processes of yap_acall, the call.proc of yaphooks, like a Pipeline '
+    def __init__(self, procs, cmds):
+        self.procs = [
+            AsyncProcess(proc, args) for proc, args in zip(procs, cmds)]
+        self.cmds = cmds
+        self.pid = procs[-1].pid
+
+    @property
+    def returncode(self):
+        return self.poll()
+
+    def poll(self):
+        if any(proc.returncode is None for proc in self.procs):
+            return None
+        return areturncode(self.procs, self.cmds)[0]
+
+def areturncode(procs, cmds):
+    ' Return code and command of the last one that failed, like pipefail '
+    for proc, cmd in reversed(list(zip(procs, cmds))):
+        if proc.returncode:
+            return proc.returncode, cmd
+    return 0, cmds[-1]
+
+def decode_output(data):
+    ' Text from a command, like Popen with universal_newlines '
+    if data is None:
+        return None
+    from locale import getpreferredencoding
+    text = data.decode(
+        yapconfig.encoding or getpreferredencoding(False),
+        yapconfig.errors or 'strict')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+async def feed_ainput(f, data):
+    """ Write data to the stream f as the command reads it, and close it.
+        Data is a string, or any iterable of strings or bytes.
+        Return the error of the iterable, if any.
+    """
+    try:
+        for chunk in [data] if isinstance(data, (str, bytes)) else data:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(yapconfig.encoding or 'utf-8')
+            f.write(chunk)
+            await f.drain()
+    except (IOError, OSError):
+        pass  # The command does not read it all
+    except Exception as e:
+        return e
+    finally:
+        f.close()
+
+async def stream_alines(procs, cmds, flags, convert, feeder=None, call=None):
+    """ Yield the lines of the output as the commands write them, then check
+        the return code. Closing the iterator early stops the commands.
+        The hooks of call, if any, run when they ended.
+    """
+    newline = b'\n' if 'b' in flags else '\n'
+    try:
+        async for line in procs[-1].stdout:
+            if 'b' not in flags:
+                line = decode_output(line)
+            line = line.rstrip(newline)
+            yield convert(line) if convert else line
+    except BaseException:
+        for proc in procs:
+            if proc.returncode is None:
+                proc.terminate()
+            await proc.wait()
+        if call:
+            call.exited(areturncode(procs, cmds)[0])
+        raise
+    try:
+        for proc in procs:
+            await proc.wait()
+        code, failed = areturncode(procs, cmds)
+        if call:
+            call.exited(code)
+        input_error = feeder and await feeder
+        if input_error:
+            raise input_error
+        if code != 0 and 'n' not in flags:
+            raise CalledProcessError(code, failed)
+    except Exception as exception:
+        if call:
+            call.failed(exception)
+        raise
+'''
+
+
+csv_lib = r'''
+import csv
+
+def csv_rows(lines, types=None):
+    """ Parse csv into lists of fields. Lines are a text, or an iterable of
+        them. Iterators, like the lines of L!, are read lazily, otherwise
+        the result is a list. Types are functions to convert the fields, by
+        column.
+    """
+    lazy = iter(lines) is lines
+    if isinstance(lines, str):
+        lines = io.StringIO(lines)
+    rows = csv.reader(lines)
+    if types:
+        rows = typed_rows(rows, enumerate(types))
+    return rows if lazy else list(rows)
+
+def csv_dicts(lines, types=None):
+    """ Parse csv with a header into dicts of fields by column name, like
+        csv_rows(). Types are functions to convert the fields, by column name.
+    """
+    lazy = iter(lines) is lines
     if isinstance(lines, str):
-        lines = lines.splitlines()
-    regexc = re.compile(regex)
-    return filter(regexc.search, lines)
+        lines = io.StringIO(lines)
+    rows = csv.DictReader(lines)
+    if types:
+        rows = typed_rows(rows, types.items())
+    return rows if lazy else list(rows)
+
+def typed_rows(rows, types):
+    ' Convert the fields of the rows. Empty fields, like NULL, become None '
+    types = [(column, function) for column, function in types if function]
+    for row in rows:
+        for column, function in types:
+            value = row[column]
+            row[column] = function(value) if value else None
+        yield row
+'''
+
+
+table_lib = r'''
+from array import array
+
+class Table(object):
+    """ Columns of fields, selected by header name or index: table['PID'].
+        table.ints('PID') and table.floats('%CPU') convert a column once, to
+        compact arrays. where(), sort_by() and select() make new tables.
+    """
+    __slots__ = ('names', 'columns', 'arrays')
+
+    def __init__(self, names, columns):
+        self.names = names
+        self.columns = columns
+        self.arrays = {}  # Converted columns by (index, typecode)
+
+    @classmethod
+    def parse(cls, lines):
+        """ Split the lines into fields in one pass, by columns. The first
+            line is the header. The last field takes the rest of its line,
+            missing fields are empty.
+        """
+        if isinstance(lines, (str, bytes)):
+            lines = lines.splitlines()
+        lines = iter(lines)
+        names = next(lines, '').split()
+        columns = [[] for _ in names]
+        maxsplit = len(names) - 1
+        for line in lines:
+            fields = line.rstrip().split(None, maxsplit)
+            if not fields:
+                continue
+            if len(fields) <= maxsplit:
+                fields += [line[:0]] * (maxsplit + 1 - len(fields))
+            for column, field in zip(columns, fields):
+                column.append(field)
+        return cls(names, columns)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        ' The rows, as tuples '
+        return zip(*self.columns)
+
+    def __repr__(self):
+        return 'Table({}, {} rows)'.format(self.names, len(self))
+
+    def index(self, key):
+        return key if isinstance(key, int) else self.names.index(key)
+
+    def __getitem__(self, key):
+        return self.columns[self.index(key)]
+
+    def ints(self, key):
+        ' The column as array of integers, 0 for empty fields '
+        return self.converted(key, 'q', int, 0)
+
+    def floats(self, key):
+        ' The column as array of floats, NaN for empty fields '
+        return self.converted(key, 'd', float, float('nan'))
+
+    def converted(self, key, typecode, function, empty):
+        i = self.index(key)
+        values = self.arrays.get((i, typecode))
+        if values is None:
+            values = array(typecode, [
+                function(field) if field else empty
+                for field in self.columns[i]])
+            self.arrays[i, typecode] = values
+        return values
+
+    def take(self, rows):
+        ' A table of the rows at the given indexes '
+        table = Table(self.names, [
+            [column[i] for i in rows] for column in self.columns])
+        for key, values in self.arrays.items():
+            table.arrays[key] = array(
+                values.typecode, [values[i] for i in rows])
+        return table
+
+    def where(self, key, predicate):
+        ' The rows where predicate(field) is true '
+        column = self[key]
+        return self.take(
+            [i for i, field in enumerate(column) if predicate(field)])
+
+    def sort_by(self, key, reverse=False, numeric=False):
+        ' Sort by a column, by its values as floats if numeric, empty last '
+        column = self.floats(key) if numeric else self[key]
+        rows = range(len(column))
+        empty = []
+        if numeric:  # NaN does not compare
+            empty = [i for i in rows if column[i] != column[i]]
+            rows = [i for i in rows if column[i] == column[i]]
+        return self.take(sorted(
+            rows, key=column.__getitem__, reverse=reverse) + empty)
+
+    def select(self, *keys):
+        ' A table of some columns '
+        indexes = [self.index(key) for key in keys]
+        table = Table(
+            [self.names[i] for i in indexes],
+            [self.columns[i] for i in indexes])
+        for i, j in enumerate(indexes):
+            for typecode in 'qd':
+                if (j, typecode) in self.arrays:
+                    table.arrays[i, typecode] = self.arrays[j, typecode]
+        return table
+'''
+
+
+config_lib = r'''
+class YapConfig(object):
+    """ Settings of the runtime, that scripts can change:
+            yapconfig.spill_threshold = 2**30
+        spill_threshold: output of M! commands kept in memory, in characters
+            or bytes. Beyond it, the output is in a temporary file.
+        encoding, errors: how the text of commands is decoded and encoded,
+            without the b flag. By default, like open().
+        spawn: 'posix_spawn' to start all commands like with the x flag.
+    """
+    spill_threshold = 64 * 2**20
+    encoding = None
+    errors = None
+    spawn = 'fork'
+
+yapconfig = YapConfig()
+'''
+
+
+hooks_lib = r'''
+import atexit
+import time
+
+class YapHooks(object):
+    """ Functions that yap_call runs around commands, given their Call:
+            yaphooks.after_exit.append(lambda call: print(call.wall))
+        before_spawn: before starting the command.
+        after_spawn: once started, call.proc is the Popen or Pipeline.
+        after_exit: once ended and its output read, even if it failed.
+            For p! commands, from a thread when they end, or with
+            call.returncode None if they still run when a sink reports.
+        on_error: when yap_call raises call.error: the command failed, could
+            not start, or reading its input raised.
+        They run in the thread of the call. Without any, yap_call skips all.
+    """
+    names = ('before_spawn', 'after_spawn', 'after_exit', 'on_error')
+
+    def __init__(self):
+        self.before_spawn = []
+        self.after_spawn = []
+        self.after_exit = []
+        self.on_error = []
+
+    def __bool__(self):
+        return bool(self.before_spawn or self.after_spawn or
+                    self.after_exit or self.on_error)
+
+    def add(self, sink):
+        ' Add the methods of sink named like hooks '
+        for name in self.names:
+            if hasattr(sink, name):
+                getattr(self, name).append(getattr(sink, name))
+
+    def remove(self, sink):
+        for name in self.names:
+            if hasattr(sink, name):
+                getattr(self, name).remove(getattr(sink, name))
+
+yaphooks = YapHooks()
+
+class Call(object):
+    """ A command of yap_call, for the functions of yaphooks.
+        cmd, flags: as given to yap_call. cmd is the list of arguments, a
+            list of them for a pipeline, or the line of a shell.
+        site: (file, line) of the code calling yap_call.
+        start, end: time.time() of the start and end. wall: seconds between.
+        user, sys: CPU time of the children that ended meanwhile, so
+            approximate when commands run in parallel.
+        bytes_in, bytes_out: size of the input and outputs, in characters or
+            bytes, when they are in memory. Otherwise 0.
+        proc: the Popen or Pipeline, once spawned.
+        returncode: once ended. error: the exception raised, for on_error.
+    """
+    def __init__(self, cmd, flags, infile, site):
+        self.cmd = cmd
+        self.flags = flags
+        self.site = site
+        self.start = self.end = None
+        self.wall = self.user = self.sys = 0.0
+        self.bytes_in = data_size(infile)
+        self.bytes_out = 0
+        self.proc = self.returncode = self.error = None
+
+    def __repr__(self):
+        return '<Call {} at {}:{}>'.format(command_text(self.cmd), *self.site)
+
+    def spawning(self):
+        import resource
+        self.usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.clock = time.perf_counter()
+        self.start = time.time()
+        for hook in yaphooks.before_spawn:
+            hook(self)
+
+    def spawned(self, proc):
+        self.proc = proc
+        for hook in yaphooks.after_spawn:
+            hook(self)
+
+    def exited(self, returncode, out=None, err=None):
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.wall = time.perf_counter() - self.clock
+        self.end = self.start + self.wall
+        self.user = usage.ru_utime - self.usage.ru_utime
+        self.sys = usage.ru_stime - self.usage.ru_stime
+        self.returncode = returncode
+        self.bytes_out = data_size(out) + data_size(err)
+        for hook in yaphooks.after_exit:
+            hook(self)
+
+    def failed(self, exception):
+        self.error = exception
+        for hook in yaphooks.on_error:
+            hook(self)
+
+    def background(self, thread=True):
+        """ For a p! command: run the exit hooks once it ends, from a thread,
+            or from the caller with exited_background() if not thread.
+        """
+        with background_lock:
+            background_calls.append(self)
+        if thread:
+            threading.Thread(target=self.wait_background, daemon=True).start()
+
+    def wait_background(self):
+        self.exited_background(self.proc.wait())
+
+    def exited_background(self, returncode):
+        ' Run the exit hooks of a p! command, unless they already ran '
+        with background_lock:
+            if self not in background_calls:
+                return
+            background_calls.remove(self)
+        self.exited(returncode)
+
+background_calls = []  # Of p! commands, until their exit hooks run
+background_lock = threading.Lock()
+
+def report_background():
+    """ Run the exit hooks of the p! commands that ended, before a report.
+        Those still running get returncode None.
+    """
+    for call in list(background_calls):
+        call.exited_background(call.proc.poll())
+
+def call_site():
+    ' (file, line) of the code calling the function that calls call_site() '
+    frame = sys._getframe(2)
+    return frame.f_code.co_filename, frame.f_lineno
+
+def command_text(cmd):
+    ' The command line of a command, of a pipeline of them or of a shell '
+    if isinstance(cmd, str):
+        return cmd
+    if cmd and isinstance(cmd[0], list):
+        return ' | '.join(map(command_text, cmd))
+    return ' '.join(map(escape_sh, cmd))
+
+def command_name(cmd):
+    ' The programs of a command, without their paths and arguments '
+    if isinstance(cmd, str):
+        return cmd.split(None, 1)[0] if cmd.strip() else ''
+    if cmd and isinstance(cmd[0], list):
+        return '|'.join(map(command_name, cmd))
+    return os.path.basename(cmd[0]) if cmd else ''
+
+def data_size(data):
+    ' Length of the input or output of a command, 0 if it is not known '
+    if isinstance(data, (str, bytes, SpilledOutput)):
+        return len(data)
+    return 0
+
+class Profiler(object):
+    """ Statistics of the commands by call site: number of calls, wall time,
+        CPU time of the children, size of the inputs and outputs and exit
+        codes, 'error' when they could not start, 'running' for p! commands
+        not ended at the report. A sink of yaphooks.
+    """
+    def __init__(self):
+        self.sites = {}  # (file, line): statistics
+        self.lock = threading.Lock()
+
+    def after_exit(self, call):
+        self.record(
+            call, 'running' if call.returncode is None else call.returncode)
+
+    def on_error(self, call):
+        if call.returncode is None:  # Not started
+            self.record(call, 'error')
+
+    def record(self, call, code):
+        with self.lock:
+            stats = self.sites.get(call.site)
+            if stats is None:
+                stats = self.sites[call.site] = {
+                    'site': '{}:{}'.format(*call.site),
+                    'command': command_text(call.cmd),
+                    'calls': 0, 'wall': 0.0, 'user': 0.0, 'sys': 0.0,
+                    'bytes_in': 0, 'bytes_out': 0, 'exit_codes': {}}
+            stats['calls'] += 1
+            stats['wall'] += call.wall
+            stats['user'] += call.user
+            stats['sys'] += call.sys
+            stats['bytes_in'] += call.bytes_in
+            stats['bytes_out'] += call.bytes_out
+            codes = stats['exit_codes']
+            codes[str(code)] = codes.get(str(code), 0) + 1
+
+    def report(self, output='-'):
+        """ Print the statistics on stderr, the slowest sites first. Also
+            write them as a JSON list to the file output, if not '-'.
+        """
+        report_background()
+        sites = sorted(self.sites.values(), key=lambda s: -s['wall'])
+        row = '{:>6} {:>9} {:>9} {:>9} {:>10} {:>10} {:>6}  {}  {}'
+        print(row.format('calls', 'wall', 'user', 'sys', 'in', 'out',
+                         'failed', 'site', 'command'), file=sys.stderr)
+        for s in sites:
+            print(row.format(
+                s['calls'], '%.3f' % s['wall'], '%.3f' % s['user'],
+                '%.3f' % s['sys'], s['bytes_in'], s['bytes_out'],
+                s['calls'] - s['exit_codes'].get('0', 0) -
+                s['exit_codes'].get('running', 0),
+                s['site'], s['command']), file=sys.stderr)
+        if output != '-':
+            with open(output, 'w') as f:
+                json.dump(sites, f, indent=2)
+
+class Tracer(object):
+    """ Timeline of the processes, and of the threads of the script calling
+        them and running Python in between, as Chrome trace events that
+        Perfetto or chrome://tracing show. Each process has its own track.
+        A sink of yaphooks.
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.events = []
+        self.running = {}  # pid: event of a process not finished yet
+        self.python = {threading.get_native_id(): 0}  # thread: span start
+        self.threads = set()  # Named in the trace
+
+    def now(self):
+        ' Microseconds since the start of the trace '
+        return self.micros(time.time())
+
+    def micros(self, t):
+        return (t - self.origin) * 1e6
+
+    def name_track(self, tid, name):
+        self.events.append({'name': 'thread_name', 'ph': 'M',
+                            'pid': os.getpid(), 'tid': tid,
+                            'args': {'name': name}})
+
+    def event(self, category, name, start, end, tid, **args):
+        self.events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'ts': start,
+            'dur': end - start, 'pid': os.getpid(), 'tid': tid, 'args': args})
+
+    def before_spawn(self, call):
+        ' End the Python span of the thread '
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.name_track(tid, threading.current_thread().name)
+        if tid in self.python:
+            self.event('python', 'python', self.python.pop(tid),
+                       self.micros(call.start), tid)
+
+    def after_spawn(self, call):
+        ' Time the processes of the call, in threads '
+        for child in getattr(call.proc, 'procs', [call.proc]):
+            args = child.args
+            text = args if isinstance(args, str) else command_text(args)
+            self.name_track(child.pid, text)
+            event = {
+                'name': text.split(' ', 1)[0], 'cat': 'process', 'ph': 'X',
+                'ts': self.now(), 'pid': os.getpid(), 'tid': child.pid,
+                'args': {'command': text, 'site': '{}:{}'.format(*call.site)}}
+            self.running[child.pid] = event, child
+            threading.Thread(
+                target=self.wait, args=(event, child), daemon=True).start()
+        if 'p' in call.flags:  # In the background, the script goes on
+            self.end_call(call, self.now())
+
+    def after_exit(self, call):
+        if 'p' not in call.flags:  # Ended at its start
+            self.end_call(call, self.micros(call.end))
+
+    def on_error(self, call):
+        if call.returncode is None:  # Not started
+            self.end_call(call, self.now())
+
+    def end_call(self, call, end):
+        ' Add the call, and start a Python span in its thread '
+        tid = threading.get_native_id()
+        self.event('call', command_text(call.cmd), self.micros(call.start),
+                   end, tid, site='{}:{}'.format(*call.site))
+        self.python[tid] = end
+
+    def wait(self, event, child):
+        ' End the event of a process when it exits, leaving it to reap '
+        try:
+            status = os.waitid(
+                os.P_PID, child.pid, os.WEXITED | os.WNOWAIT).si_status
+        except ChildProcessError:  # Reaped by its Popen, or by asyncio
+            end = self.now()
+            for _ in range(100):  # Until its owner has the status
+                if child.returncode is not None:
+                    break
+                time.sleep(0.001)
+            self.finish(event, child, child.returncode, end)
+            return
+        self.finish(event, child, status)
+
+    def finish(self, event, child, status, end=None):
+        if self.running.pop(child.pid, None):
+            event['dur'] = (self.now() if end is None else end) - event['ts']
+            event['args']['status'] = status
+            self.events.append(event)
+
+    def report(self, output):
+        ' Write the trace as JSON to the file output '
+        now = self.now()
+        alive = set(thread.native_id for thread in threading.enumerate())
+        for tid, start in list(self.python.items()):
+            if tid in alive:
+                self.event('python', 'python', start, now, tid)
+        for event, child in list(self.running.values()):
+            # Not seen by its thread yet, or still running in the background
+            self.finish(event, child, child.poll())
+        with open(output, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, f)
+
+class Metrics(object):
+    """ Counters of the commands by programs, in the text format of
+        Prometheus, for the textfile collector of node_exporter. Failures
+        are the commands that returned non-zero or could not start.
+        A sink of yaphooks.
+    """
+    def __init__(self):
+        self.commands = {}  # name: [calls, failures, seconds, user, sys]
+        self.lock = threading.Lock()
+
+    def after_exit(self, call):
+        with self.lock:
+            stats = self.commands.setdefault(
+                command_name(call.cmd), [0, 0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += call.returncode not in (0, None)  # None: running
+            stats[2] += call.wall
+            stats[3] += call.user
+            stats[4] += call.sys
+
+    def on_error(self, call):
+        if call.returncode is None:  # Not started
+            with self.lock:
+                stats = self.commands.setdefault(
+                    command_name(call.cmd), [0, 0, 0.0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += 1
+
+    def text(self):
+        ' The metrics in the Prometheus text format '
+        report_background()
+
+        def label(name):
+            return 'command="{}"'.format(
+                name.replace('\\', r'\\').replace('"', r'\"')
+                .replace('\n', r'\n'))
+
+        names = sorted(self.commands)
+        lines = []
+        for metric, kind, doc, index in (
+                ('yap_commands_total', 'counter', 'Commands run', 0),
+                ('yap_command_failures_total', 'counter',
+                 'Commands that failed or could not start', 1),
+                ('yap_command_seconds', 'summary',
+                 'Wall time of the commands', 2)):
+            lines.append('# HELP {} {}'.format(metric, doc))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for name in names:
+                stats = self.commands[name]
+                if kind == 'summary':
+                    lines.append('{}_sum{{{}}} {}'.format(
+                        metric, label(name), stats[index]))
+                    lines.append('{}_count{{{}}} {}'.format(
+                        metric, label(name), stats[0]))
+                else:
+                    lines.append('{}{{{}}} {}'.format(
+                        metric, label(name), stats[index]))
+        metric = 'yap_command_cpu_seconds_total'
+        lines.append('# HELP {} CPU time of the commands'.format(metric))
+        lines.append('# TYPE {} counter'.format(metric))
+        for name in names:
+            for mode, index in (('user', 3), ('system', 4)):
+                lines.append('{}{{{},mode="{}"}} {}'.format(
+                    metric, label(name), mode, self.commands[name][index]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output):
+        ' Replace the file output, that collectors never see half written '
+        tmp_path = '{}.{}.tmp'.format(output, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.text())
+        os.rename(tmp_path, output)
+
+def start_profiling(output='-'):
+    """ Record the commands, and report them at exit, see Profiler.report().
+        yap --profile starts it with $YAP_PROFILE.
+    """
+    profiler = Profiler()
+    yaphooks.add(profiler)
+    atexit.register(profiler.report, output)
+    return profiler
+
+def start_tracing(output):
+    """ Record the processes, and write their trace to the file output at
+        exit, see Tracer. yap --trace starts it with $YAP_TRACE.
+    """
+    tracer = Tracer()
+    yaphooks.add(tracer)
+    atexit.register(tracer.report, output)
+    return tracer
+
+def start_metrics(output):
+    """ Count the commands, and write the metrics to the file output at exit,
+        see Metrics. yap --metrics starts it with $YAP_METRICS.
+    """
+    metrics = Metrics()
+    yaphooks.add(metrics)
+    atexit.register(metrics.write, output)
+    return metrics
+
+def start_sinks(environ):
+    """ Start the sinks that yap asks for in environ, and remove them from it:
+        not for the commands, that inherit it.
+    """
+    if environ.get('YAP_PROFILE'):
+        start_profiling(environ.pop('YAP_PROFILE'))
+    if environ.get('YAP_TRACE'):
+        start_tracing(environ.pop('YAP_TRACE'))
+    if environ.get('YAP_METRICS'):
+        start_metrics(environ.pop('YAP_METRICS'))
+
+start_sinks(os.environ)
+'''
+
+
+spill_lib = r'''
+def communicate_spilled(proc, indata=None):
+    """ Like proc.communicate(), but the output goes to a temporary file
+        once it is bigger than yapconfig.spill_threshold.
+    """
+    threads, errs = drain_stderr(getattr(proc, 'procs', [proc]))
+    if proc.stdin:
+        threads.append(feed_input(proc.stdin, indata))
+    try:
+        out = spool(proc.stdout, yapconfig.spill_threshold)
+    finally:
+        proc.stdout.close()
+    for thread in threads:
+        thread.join()
+    proc.wait()
+    return out, join_outputs(errs)
+
+def spool(f, threshold):
+    """ Read f to its end, in memory up to threshold, then in a temporary
+        file. Return a str or bytes, or a SpilledOutput.
+    """
+    data = f.read(threshold + 1)
+    if len(data) <= threshold:
+        return data
+    import shutil
+    import tempfile
+    encoding = getattr(f, 'encoding', None)
+    spilled = tempfile.NamedTemporaryFile(
+        'w+' if encoding else 'w+b', encoding=encoding, prefix='yap-')
+    spilled.write(data)
+    del data
+    shutil.copyfileobj(f, spilled)
+    spilled.flush()
+    return SpilledOutput(spilled, encoding)
+
+class SpilledOutput(object):
+    """ An output too big for memory, in a temporary file at .name until this
+        object is closed or deleted. Iterate on its lines, read() it, or map
+        it with mmap(). Otherwise it acts like the str or bytes of the output:
+        ==, slices, + and the other methods of str or bytes read it all in
+        memory, unless the file is enough. len() is its size in bytes.
+    """
+    def __init__(self, f, encoding=None):
+        self.file = f
+        self.name = f.name
+        self.encoding = encoding
+
+    def open(self):
+        ' A new file object reading the output from the start '
+        if self.encoding:
+            return open(self.name, encoding=self.encoding)
+        return open(self.name, 'rb')
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    def mmap(self):
+        ' The bytes of the output, mapped from the file '
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        ' The lines, with their newline like those of a file '
+        with self.open() as f:
+            for line in f:
+                yield line
+
+    def splitlines(self, keepends=False):
+        if keepends:
+            return self.read().splitlines(keepends)
+        return [part for line in self for part in line.splitlines()]
+
+    def split(self, sep=None, maxsplit=-1):
+        if sep is not None or maxsplit != -1:
+            return self.read().split(sep, maxsplit)
+        return [field for line in self for field in line.split()]
+
+    def __len__(self):
+        ' The size in bytes '
+        return os.path.getsize(self.name)
+
+    def __contains__(self, sub):
+        if self.encoding:
+            sub = sub.encode(self.encoding)
+        with self.mmap() as data:
+            return data.find(sub) >= 0
+
+    def __getitem__(self, key):
+        if self.encoding:  # Characters, not bytes of the file
+            return self.read()[key]
+        with self.mmap() as data:
+            return data[key]
+
+    def __eq__(self, other):
+        if isinstance(other, SpilledOutput):
+            other = other.read()
+        elif not isinstance(other, (str, bytes)):
+            return NotImplemented
+        if not self.encoding and len(other) != len(self):
+            return False
+        return self.read() == other
+
+    def __hash__(self):
+        return hash(self.read())
+
+    def __add__(self, other):
+        return self.read() + other
+
+    def __radd__(self, other):
+        return other + self.read()
+
+    def __getattr__(self, name):
+        ' The other methods of str or bytes, on the output read in memory '
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.read(), name)
+
+    def __str__(self):
+        return self.read() if self.encoding else str(self.read())
+
+    def __bytes__(self):
+        data = self.read()
+        return data.encode(self.encoding) if self.encoding else data
+
+    def __int__(self):
+        return int(self.read())
+
+    def __float__(self):
+        return float(self.read())
+
+    def __repr__(self):
+        return '<SpilledOutput of {} bytes in {}>'.format(len(self), self.name)
 '''
 
 
@@ -532,16 +2485,6 @@ else:
     blue = gray = green = orange = red = _yap_color = lambda s, c='': s
 '''
 
-imports = '''
-import os
-from os import listdir
-from os.path import *
-import sys
-from sys import stdin, stdout, stderr, exit
-from pprint import pprint
-from glob import glob
-'''
-
 logging_lib = '''
 import logging
 from logging import debug, info, warning, error
@@ -549,6 +2492,117 @@ logging.basicConfig(level=logging.INFO, format='{}: %(levelname)s: %(message)s'.
 '''
 
 
+import os.path as _ospath
+
+# Runtime libraries as (names they define, names they use, code), in order
+# of emission. Scripts only get the libraries defining names they use,
+# directly or through another library.
+# The imports and the logging setup are always in the scripts, the others
+# are in yaplib unless inline_libs.
+libs = [
+    ('os', '', 'import os'),
+    ('listdir', '', 'from os import listdir'),
+    (' '.join(_ospath.__all__), '', 'from os.path import *'),
+    ('sys', '', 'import sys'),
+    ('stdin stdout stderr exit', '',
+     'from sys import stdin, stdout, stderr, exit'),
+    ('pprint', '', 'from pprint import pprint'),
+    ('glob', '', 'from glob import glob'),
+    ('re', '', 'import re'),
+    ('json', '', 'import json'),
+    ('io', '', 'import io'),
+    ('mmap', '', 'import mmap'),
+    ('threading', '', 'import threading'),
+    ('logging debug info warning error', '', logging_lib),
+    ('blue gray green orange red _yap_color', 'sys', color_lib),
+    ('split_lines_fields split_fields_lines map_lines json_lines splitlines '
+     'splitfields loadjson concat joinlines joinfields joinpaths read write '
+     'grep grep_files', 'io json mmap os re', convert_lib),
+    ('csv_rows csv_dicts', 'io', csv_lib),
+    ('Table', '', table_lib),
+    ('yapconfig YapConfig', '', config_lib),
+    ('yaphooks YapHooks Call call_site command_text command_name data_size '
+     'Profiler Tracer Metrics start_profiling start_tracing start_metrics '
+     'start_sinks report_background',
+     'json os sys threading SpilledOutput escape_sh', hooks_lib),
+    ('communicate_spilled spool SpilledOutput',
+     'mmap os drain_stderr feed_input join_outputs yapconfig', spill_lib),
+    ('listget', '', listget_lib),
+    ('MissingParameter missingget missingindex', '', missing_lib),
+    ('yap_call hooked_call run_call call_result escape_sh spawn_process '
+     'find_program yap_require Pipeline drain_stderr join_outputs feed_input '
+     'job_groups coshells Popen PIPE STDOUT CalledProcessError',
+     'os re sys threading Call call_site communicate_spilled coshell_call '
+     'yapconfig yaphooks', call_lib),
+    ('Jobs Job JobsError par_for', 'os job_groups', jobs_lib),
+    ('Coprocess Coshell shell_line coshell_call',
+     'os sys threading CalledProcessError PIPE Popen call_result coshells '
+     'escape_sh yapconfig', coproc_lib),
+    ('yap_acall',
+     'os Call CalledProcessError PIPE STDOUT call_result call_site escape_sh '
+     'find_program job_groups join_outputs yapconfig yaphooks', async_lib),
+]
+
+yaplib_libs = [
+    color_lib, convert_lib, csv_lib, table_lib, listget_lib, missing_lib,
+    config_lib, hooks_lib, call_lib, spill_lib, jobs_lib, coproc_lib,
+    async_lib]
+
+# Names read, not attributes nor keyword arguments and assignments
+re_name = re.compile(r'(?<![\w.]) [A-Za-z_]\w*\b (?! \s* =[^=] )', re.X)
+
+_libs_names = None
+
+def libs_names():
+    """ For each library: (names defined, names used, code). Split when
+        compiling, not for the scripts found in the cache.
+    """
+    global _libs_names
+    if _libs_names is None:
+        _libs_names = [
+            (set(names.split()), set(uses.split()), code)
+            for names, uses, code in libs
+        ]
+    return _libs_names
+
+
+def used_libs(pycode, inline=True):
+    ''' Return the code of the libraries that define names used in pycode,
+        and of those they depend on. Any identifier counts, even in strings.
+        If not inline, the dependencies of yaplib libraries are left out.
+    '''
+    names = set(re_name.findall(pycode))
+    lib_names = libs_names()
+    used = [False] * len(lib_names)
+    found = True
+    while found:  # Until all dependencies are in
+        found = False
+        for i, (defined, uses, code) in enumerate(lib_names):
+            if not used[i] and not names.isdisjoint(defined):
+                used[i] = found = True
+                if inline or code not in yaplib_libs:
+                    names.update(uses)
+    return [code for (_, _, code), u in zip(lib_names, used) if u]
+
+
+def yaplib_source():
+    ' The module of the runtime libraries, imported by compiled scripts '
+    names = ' '.join(
+        names for names, _, code in libs if code in yaplib_libs)
+    return '\n'.join(
+        ['# YaP runtime, generated by yap --lib'] + used_libs(names)) + '\n'
+
+
+def yaplib_import(pycode, libs_code):
+    ' Import the names defined in yaplib and used in pycode '
+    names = set(re_name.findall(pycode))
+    imported = set()
+    for defined, _, code in libs_names():
+        if code in libs_code:
+            imported.update(defined & names)
+    return 'from yaplib import {}'.format(', '.join(sorted(imported)))
+
+
 def make_globals(filename):
     return {
         '__file__': filename,
@@ -558,33 +2612,313 @@ def make_globals(filename):
     }
 
 
-def compile_yap(source):
-
-    headers = [
-        '#!/usr/bin/env python',
-        imports,
+def compile_yap(source, source_map=None, filename=None):
+    """ Compile yap source to Python code: the runtime it uses, then the
+        script. If source_map is a list, fill it with the line of the source
+        of each line of the code, or None for the runtime. Syntax errors are
+        in filename.
+    """
+    script_map = []
+    programs = []
+    try:
+        pycode = expand_python(source, script_map, programs)
+    except SyntaxError as e:
+        e.filename = e.filename or filename
+        raise
+    # Before the script, check that its programs are there
+    require = ''
+    if check_programs and programs:
+        require = 'yap_require({!r})'.format(sorted(set(programs)))
+    runtime_code = require + '\n' + pycode
+    headers = ['#!/usr/bin/env python']
+    if inline_libs:
+        headers += used_libs(runtime_code)
+    else:
+        used = used_libs(runtime_code, inline=False)
+        headers += [code for code in used if code not in yaplib_libs]
+        shared = [code for code in used if code in yaplib_libs]
+        if shared:
+            headers.append(yaplib_import(runtime_code, shared))
+    if require:
+        headers.append(require)
+    header = '\n'.join(headers) + '\n\n'
+    if source_map is not None:
+        source_map.extend([None] * header.count('\n') + script_map)
+    return header + pycode
+
+
+def compile_options():
+    " Global settings that change the compiled code "
+    return {'dry_run': dry_run, 'inline_libs': inline_libs,
+            'async_calls': async_calls, 'check_programs': check_programs}
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'yap')
+
+
+_compiler_hash = None
+
+def compiler_hash():
+    " Changes with any version of yap "
+    global _compiler_hash
+    if _compiler_hash is None:
+        with open(__file__, 'rb') as f:
+            _compiler_hash = hashlib.sha1(f.read()).hexdigest()
+    return _compiler_hash
+
+
+def cache_key(source, filename):
+    " Identify a compilation by the source, the compiler and the options "
+    h = hashlib.sha1()
+    for part in (compiler_hash(), sys.version, filename,
+                 repr(sorted(compile_options().items())), source):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def write_atomic(path, data):
+    " Concurrent runs read either nothing or all of it "
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def save_cached(directory, key, pycode, code):
+    " Store the generated Python and its code object, then make room "
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    write_atomic(os.path.join(directory, key + '.py'), pycode.encode('utf-8'))
+    write_atomic(os.path.join(directory, key + '.code'), marshal.dumps(code))
+    evict_cache(directory, cache_max_size)
+
+
+def evict_cache(directory, max_size):
+    " Remove the least recently used entries until the cache fits "
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(('.py', '.code')):
+            continue
+        st = os.stat(os.path.join(directory, name))
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass  # Removed by a concurrent run
+        total -= size
+
+
+def compile_py(pycode, filename, source_map):
+    """ Return the code objects of the runtime and of the script, that have
+        the lines of the source thanks to source_map, see compile_yap().
+        With async calls, allow await at the top level of the script.
+    """
+    import ast
+    try:
+        tree = ast.parse(pycode, filename)
+    except SyntaxError as e:  # Point to the source, showing the Python code
+        if e.lineno and source_map[e.lineno - 1]:
+            if e.end_lineno:
+                e.end_lineno += source_map[e.lineno - 1] - e.lineno
+            e.lineno = source_map[e.lineno - 1]
+        raise
+    split = 0
+    while (split < len(tree.body) and
+           source_map[tree.body[split].lineno - 1] is None):
+        split += 1
+    runtime, script = tree.body[:split], tree.body[split:]
+    for node in script:
+        for child in ast.walk(node):
+            if getattr(child, 'lineno', None):
+                child.lineno = source_map[child.lineno - 1]
+            if getattr(child, 'end_lineno', None):
+                child.end_lineno = source_map[child.end_lineno - 1]
+    flags = ast.PyCF_ALLOW_TOP_LEVEL_AWAIT if async_calls else 0
+    return (
+        compile(ast.Module(runtime, []), '<yap runtime>', 'exec'),
+        compile(ast.Module(script, []), filename, 'exec', flags))
+
+
+def compile_cached(source, filename):
+    """ Compile yap source to the code objects of compile_py(). Reuse the
+        result of a previous run with the same source, compiler and options,
+        without parsing.
+    """
+    source_map = []
+    if not use_cache:
+        pycode = compile_yap(source, source_map, filename)
+        return compile_py(pycode, filename, source_map)
+
+    directory = cache_dir()
+    key = cache_key(source, filename)
+    code_path = os.path.join(directory, key + '.code')
+    try:
+        with open(code_path, 'rb') as f:
+            code = marshal.load(f)
+        os.utime(code_path, None)  # Recently used, evict last
+        return code
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass  # Not cached yet, or corrupted
+
+    pycode = compile_yap(source, source_map, filename)
+    code = compile_py(pycode, filename, source_map)
+    try:
+        save_cached(directory, key, pycode, code)
+    except (IOError, OSError):
+        pass  # Read-only or full, run without cache
+    return code
+
+
+def install_yaplib():
+    """ Write yaplib in the cache, where Python keeps it byte-compiled, and
+        make it importable. Return False if that is not possible.
+    """
+    libs_dir = os.path.join(cache_dir(), 'lib')
+    directory = os.path.join(libs_dir, compiler_hash())
+    try:
+        if not os.path.exists(os.path.join(directory, 'yaplib.py')):
+            import py_compile
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'yaplib.py')
+            write_atomic(path, yaplib_source().encode('utf-8'))
+            py_compile.compile(path)  # Even with PYTHONDONTWRITEBYTECODE
+            evict_yaplibs(libs_dir, yaplib_max_age)
+        else:
+            os.utime(directory, None)  # Recently used, evict last
+    except (IOError, OSError):
+        return False
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return True
 
-        # YaP libs
-        logging_lib,
-        color_lib,
-        convert_lib,
-        listget_lib,
-        missing_lib,
-        call_lib,
-    ]
 
-    pycode = '\n'.join(headers) + '\n\n' + expand_python(source)
-    return pycode
+def evict_yaplibs(libs_dir, max_age):
+    ''' Remove the yaplib of the versions of yap not run for max_age seconds.
+        Others may run at the same time, sharing the cache.
+    '''
+    import shutil
+    import time
+    oldest = time.time() - max_age
+    for name in os.listdir(libs_dir):
+        path = os.path.join(libs_dir, name)
+        try:
+            if os.stat(path).st_mtime < oldest:
+                shutil.rmtree(path, True)
+        except OSError:
+            pass  # Removed by a concurrent run
+
+
+def write_yaplib(directory):
+    path = os.path.join(directory, 'yaplib.py')
+    with open(path, 'w') as f:
+        f.write(yaplib_source())
+    print('Runtime written to {}'.format(path))
+
+
+def write_client(directory):
+    """ Write in directory the client of yap --server: the command yapc, and
+        the module yapclient it imports, byte-compiled.
+    """
+    import py_compile
+    path = os.path.join(directory, 'yapclient.py')
+    with open(path, 'w') as f:
+        f.write('# Client of yap --server, generated by yap --client\n')
+        f.write(client_lib)
+        f.write('\nyap_dir = {!r}  # When there is no server\n'.format(
+            os.path.dirname(os.path.realpath(__file__))))
+    py_compile.compile(path)
+    command = os.path.join(directory, 'yapc')
+    with open(command, 'w') as f:
+        f.write('#!{} -S\nimport yapclient\nyapclient.main()\n'.format(
+            sys.executable))
+    os.chmod(command, 0o755)
+    print('Client written to {}'.format(command))
+
+
+class LineProfiler(object):
+    """ Time spent on each line of a script run by yap, including the
+        functions it calls and the commands it waits for, and CPU time of
+        these commands. Lines running in parallel threads add up.
+    """
+    def __init__(self, filename, source):
+        import threading
+        self.filename = filename
+        self.source = source.splitlines()
+        self.lines = {}  # line: [hits, wall time, children CPU time]
+        self.lock = threading.Lock()
+
+    def start(self):
+        " Trace the script, in all threads, and report at exit "
+        import atexit
+        import threading
+        threading.settrace(self.trace)
+        sys.settrace(self.trace)
+        atexit.register(self.report)
+
+    def stop(self):
+        import threading
+        sys.settrace(None)
+        threading.settrace(None)
+
+    def now(self):
+        import time
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.perf_counter(), usage.ru_utime + usage.ru_stime
+
+    def trace(self, frame, event, arg):
+        " Global trace function, that times the frames of the script "
+        if frame.f_code.co_filename != self.filename:
+            return None
+        last = [None, None]  # Current line, and when it started
+
+        def trace_frame(frame, event, arg):
+            now = self.now()
+            if last[0] is not None:
+                with self.lock:
+                    stats = self.lines.setdefault(last[0], [0, 0.0, 0.0])
+                    stats[1] += now[0] - last[1][0]
+                    stats[2] += now[1] - last[1][1]
+            if event == 'line':
+                with self.lock:
+                    self.lines.setdefault(frame.f_lineno, [0, 0.0, 0.0])[0] += 1
+                last[:] = frame.f_lineno, now
+            else:  # Returned, or left for a caller in other file
+                last[0] = None
+            return trace_frame
+        return trace_frame
+
+    def report(self):
+        " Print the statistics of the lines that ran, on stderr "
+        self.stop()
+        row = '{:>6} {:>8} {:>9} {:>9}  {}'
+        print(row.format('line', 'hits', 'wall', 'children', 'source'),
+              file=sys.stderr)
+        for line, (hits, wall, children) in sorted(self.lines.items()):
+            source = (self.source[line - 1].rstrip()
+                      if 0 < line <= len(self.source) else '')
+            print(row.format(line, hits, '%.3f' % wall, '%.3f' % children,
+                             source), file=sys.stderr)
 
 
 def run(args):
     " Compile yap file and execute it, or just save it "
+    global inline_libs
+
     with sys.stdin if args.source == '-' else open(args.source) as f:
         source = f.read()
 
-    pycode = compile_yap(source)
-
     if args.output:
+        pycode = compile_yap(source, filename=args.source)
         if args.output == '-':
             print(pycode)
         else:
@@ -592,17 +2926,310 @@ def run(args):
                 f.write(pycode)
             print('Compiled to {}'.format(args.output))
     else:
+        if not inline_libs and not (use_cache and install_yaplib()):
+            inline_libs = True  # yaplib is not available, embed it
+        runtime, script = compile_cached(source, args.source)
         sys.argv = [args.source] + args.script_args
-        exec(compile(pycode, args.source, 'exec'), make_globals(args.source))
-
+        script_globals = make_globals(args.source)
+        try:
+            exec(runtime, script_globals)
+        except ImportError as e:
+            if inline_libs or e.name != 'yaplib':
+                raise
+            inline_libs = True  # Removed meanwhile, embed it
+            runtime, script = compile_cached(source, args.source)
+            exec(runtime, script_globals)
+        if 'yaplib' in sys.modules:  # Imported before main(), by yap --server
+            sys.modules['yaplib'].start_sinks(os.environ)
+        if profile_lines:
+            LineProfiler(args.source, source).start()
+        # A script with await at the top level is a coroutine
+        coroutine = eval(script, script_globals)
+        if coroutine is not None:
+            import asyncio
+            asyncio.run(coroutine)
+
+
+# Client of yap --server, written by yap --client. Python keeps this module
+# byte-compiled: a script only waits for the interpreter to start.
+client_lib = r'''
+import os
+import sys
+import marshal
+import resource
+from array import array
+# Not socket nor signal, that import enum, slower than the rest of the client
+import _socket
+import _signal
+
+def connect_server(path, cmd_args):
+    """ Run yap with cmd_args in the server listening at path, started by
+        yap --server, and exit like it. Return if there is no server, or if
+        it cannot run the script like this client would.
+    """
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return
+    umask = os.umask(0)
+    os.umask(umask)
+    request = marshal.dumps({
+        'argv': cmd_args,
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+        'umask': umask,
+        'rlimits': {
+            name: resource.getrlimit(getattr(resource, name))
+            for name in dir(resource) if name.startswith('RLIMIT_')},
+    })
+    request = len(request).to_bytes(4, 'big') + request
+    # The standard files go with the first bytes
+    sent = client.sendmsg([request], [(
+        _socket.SOL_SOCKET, _socket.SCM_RIGHTS, array('i', [0, 1, 2]))])
+    client.sendall(request[sent:])
+
+    worker = []
+
+    def forward(signum, frame):
+        if worker:
+            try:
+                os.killpg(worker[0], signum)
+            except OSError:
+                pass  # Ended
+    handlers = {
+        signum: _signal.signal(signum, forward)
+        for signum in (_signal.SIGINT, _signal.SIGTERM, _signal.SIGHUP,
+                       _signal.SIGQUIT)}
+
+    # Lines "pid <worker>" from the worker, then "status <code>". Or "local"
+    # if the client must run the script itself
+    data = b''
+    while True:
+        received = client.recv(4096)
+        if not received:
+            sys.exit('The yap server at {} stopped'.format(path))
+        data += received
+        while b'\n' in data:
+            line, data = data.split(b'\n', 1)
+            name, _, value = line.partition(b' ')
+            if name == b'local':
+                client.close()
+                for signum, handler in handlers.items():
+                    _signal.signal(signum, handler)
+                return
+            if name == b'pid':
+                worker.append(int(value))
+                continue
+            status = int(value)
+            if status < 0:  # Killed by a signal, like the worker
+                try:
+                    _signal.signal(-status, _signal.SIG_DFL)
+                except OSError:
+                    pass  # Like SIGKILL, that has no handler
+                os.kill(os.getpid(), -status)
+                status = 128 - status
+            sys.exit(status)
+
+def main():
+    " Run yap in the server at $YAP_SERVER, or with the compiler "
+    if os.environ.get('YAP_SERVER'):
+        connect_server(os.environ['YAP_SERVER'], sys.argv[1:])
+    # Like the command yap, with the module yap byte-compiled
+    run_yap = ('import sys; sys.path[0] = {!r}; import yap; '
+               'yap.main(sys.argv[1:])').format(yap_dir)
+    os.execv(sys.executable, [sys.executable, '-c', run_yap] + sys.argv[1:])
+'''
 
-def main(cmd_args):
-    " Parse arguments and call run() "
-    global dry_run
 
+def serve(path):
+    """ Listen on the Unix socket path, and run the yap command of each
+        client in a worker forked from this process, where Python, the
+        compiler and the runtime are loaded already. The worker takes the
+        arguments, environment, directory, umask, resource limits, standard
+        files and PYTHONPATH of the client, and the server sends its exit
+        status back. See client_lib and worker_python_env.
+        Workers have no controlling terminal: programs that ask for a
+        password on it, like sudo or ssh, cannot.
+    """
+    import socket
+    import signal
+    import selectors
+    import importlib
+    import traceback
+    # What scripts load before running, and the runtime with its modules
+    preloaded = ['argparse', 'ast', 'asyncio', 'linecache', 'shutil']
+    if install_yaplib():
+        preloaded.append('yaplib')
+    for name in preloaded:
+        importlib.import_module(name)
+    make_parser().parse_args(['-'])  # Fill the caches of argparse and re
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.connect(path)
+        sys.exit('A yap server is running at {}'.format(path))
+    except (IOError, OSError):  # Left by a server that was killed
+        if os.path.exists(path):
+            os.remove(path)
+    umask = os.umask(0o177)  # Only for the user
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+
+    # Wake up on SIGCHLD to send the status of workers that ended
+    wakeup, wakeup_w = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wakeup, selectors.EVENT_READ)
+    clients = {}  # Worker pid: connection
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is listener:
+                    conn, _ = listener.accept()
+                    pid = os.fork()
+                    if pid == 0:
+                        code = 1
+                        try:
+                            listener.close()
+                            for other in clients.values():
+                                other.close()
+                            code = serve_worker(conn)
+                        except BaseException:
+                            traceback.print_exc()
+                        finally:
+                            os._exit(code)
+                    clients[pid] = conn
+                    continue
+                try:
+                    while os.read(wakeup, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                while clients:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        break
+                    conn = clients.pop(pid)
+                    try:
+                        conn.sendall(b'status %d\n' % (
+                            os.waitstatus_to_exitcode(status)))
+                    except (IOError, OSError):
+                        pass  # The client is gone
+                    conn.close()
+    finally:
+        os.remove(path)
+
+
+# Settings of the interpreter in the environment, that workers take from
+# their client. The others are read when the server starts: clients with other
+# values run the script themselves.
+worker_python_env = ('PYTHONPATH', 'PYTHONDONTWRITEBYTECODE', 'PYTHONUNBUFFERED')
+
+
+def python_env(environ):
+    " The settings of the interpreter in environ that workers cannot take "
+    return {name: value for name, value in environ.items()
+            if name.startswith('PYTHON') and name not in worker_python_env}
+
+
+def python_path(environ):
+    " The directories that PYTHONPATH in environ puts in sys.path "
+    return [os.path.abspath(path) for path in
+            environ.get('PYTHONPATH', '').split(os.pathsep) if path]
+
+
+def serve_worker(conn):
+    """ In a worker of serve(), receive the request of the client on conn,
+        run it like yap would, and return the exit status.
+    """
+    import socket
+    import signal
+    import atexit
+    import locale
+    import resource
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+    while len(data) < 4 or len(data) < 4 + int.from_bytes(data[:4], 'big'):
+        more = conn.recv(65536)
+        if not more:
+            raise EOFError('Request of the client cut')
+        data += more
+    request = marshal.loads(data[4:])
+    if python_env(request['env']) != python_env(os.environ):
+        conn.sendall(b'local\n')
+        return 0
+    for fd, std in zip(fds, (0, 1, 2)):
+        os.dup2(fd, std)
+        os.close(fd)
+    os.setsid()  # The client sends its signals to the group
+    os.chdir(request['cwd'])
+    for path in python_path(os.environ):  # Of the server
+        if path in sys.path:
+            sys.path.remove(path)
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.path[1:1] = python_path(os.environ)  # After the directory of yap
+    sys.dont_write_bytecode = bool(os.environ.get('PYTHONDONTWRITEBYTECODE'))
+    try:
+        locale.setlocale(locale.LC_CTYPE, '')  # Encoding of the client
+    except locale.Error:
+        pass
+    os.umask(request['umask'])
+    for name, limits in request['rlimits'].items():
+        try:
+            resource.setrlimit(getattr(resource, name), limits)
+        except (AttributeError, ValueError, OSError):
+            pass  # Unknown here, or above the hard limit of the server
+    # Buffered like in a Python started by the client
+    interactive = os.isatty(1) or os.environ.get('PYTHONUNBUFFERED')
+    sys.stdin = open(0, closefd=False)
+    sys.stdout = open(1, 'w', buffering=1 if interactive else -1,
+                      closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, errors='backslashreplace',
+                      closefd=False)
+    if 'yaplib' in sys.modules:  # Colored if the client writes to a terminal
+        exec(color_lib, vars(sys.modules['yaplib']))
+    conn.sendall(b'pid %d\n' % os.getpid())
+    conn.close()
+
+    code = 0
+    try:
+        main(request['argv'])
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        sys.excepthook(*sys.exc_info())
+        code = 1
+    # Like the interpreter when it exits
+    atexit._run_exitfuncs()
+    if code is None:
+        code = 0
+    elif not isinstance(code, int):
+        print(code, file=sys.stderr)
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return code
+
+
+def make_parser():
+    " Parser of the arguments of yap "
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('source')
+    parser.add_argument('source', nargs='?')
     parser.add_argument('script_args', nargs=argparse.REMAINDER)
     parser.add_argument('-p', '--python', action='store_true',
                         help='Compile source to python and write it')
@@ -611,12 +3238,90 @@ def main(cmd_args):
     parser.add_argument('-n', '--dry-run', action='store_true',
                         help='Shell commands will not execute, but output their '
                              'command line instead')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always compile, do not use nor fill the cache '
+                             'in $XDG_CACHE_HOME/yap')
+    parser.add_argument('--inline', action='store_true',
+                        help='Embed the runtime in the Python code, instead '
+                             'of importing it from yaplib')
+    parser.add_argument('--async', action='store_true', dest='async_calls',
+                        help='Await all commands, to run them concurrently '
+                             'in asyncio coroutines')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print statistics of the commands by call site '
+                             'at exit, on stderr')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='Also write the statistics as JSON in FILE. '
+                             'Implies --profile')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write the timeline of the processes and of the '
+                             'script in FILE, as Chrome trace events')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write counters of the commands in FILE, in the '
+                             'text format of Prometheus')
+    parser.add_argument('--profile-lines', action='store_true',
+                        help='Print the time spent on each line of the source '
+                             'at exit, on stderr')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit before starting the script if programs '
+                             'that it may run are missing')
+    parser.add_argument('--server', metavar='SOCKET',
+                        help='Listen on the Unix socket SOCKET, and run the '
+                             'scripts of yap with $YAP_SERVER=SOCKET in '
+                             'processes forked from it, already started')
+    parser.add_argument('--lib', metavar='DIR',
+                        help='Write the runtime module yaplib.py in DIR, for '
+                             'compiled scripts to import')
+    parser.add_argument('--client', metavar='DIR',
+                        help='Write in DIR yapc, a command like yap that '
+                             'starts faster with a server, see --server')
+    return parser
+
+
+def main(cmd_args=None):
+    """ Parse arguments and call run(). Without arguments, parse the ones of
+        the command, and run in the server at $YAP_SERVER if any.
+    """
+    global dry_run, use_cache, inline_libs, async_calls, profile_lines
+    global check_programs
+
+    if cmd_args is None:
+        cmd_args = sys.argv[1:]
+        if os.environ.get('YAP_SERVER') and '--server' not in cmd_args:
+            client = {}
+            exec(client_lib, client)  # yapc does this faster
+            client['connect_server'](os.environ['YAP_SERVER'], cmd_args)
+
+    parser = make_parser()
     args = parser.parse_args(cmd_args)
 
+    if args.server:
+        serve(args.server)
+        return
+    if args.client:
+        write_client(args.client)
+    if args.lib:
+        write_yaplib(args.lib)
+    if (args.lib or args.client) and not args.source:
+        return
+    elif not args.source:
+        parser.error('the source is required')
+
     if args.python and not args.output:
         args.output = args.source + '.py'
 
     dry_run = args.dry_run
+    use_cache = not args.no_cache
+    inline_libs = args.inline
+    async_calls = args.async_calls
+    profile_lines = args.profile_lines
+    check_programs = args.check
+    if args.profile or args.profile_json:  # Started by the runtime
+        os.environ['YAP_PROFILE'] = args.profile_json or '-'
+    if args.trace:
+        os.environ['YAP_TRACE'] = args.trace
+    if args.metrics:
+        os.environ['YAP_METRICS'] = args.metrics
 
     # Optional colored output
     if args.output == '-':
@@ -626,4 +3331,4 @@ def main(cmd_args):
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    main()